@@ -0,0 +1,142 @@
+from dataclasses import dataclass
+from typing import Iterator, Optional
+
+import numpy as np
+
+
+@dataclass
+class Segment:
+    # top and bottom of the highlight box in the frame, None for no box
+    box: Optional[tuple[float, float]]
+    duration: float
+
+
+def _blend(base: np.ndarray, color: tuple[int, int, int, int]) -> np.ndarray:
+    alpha = color[3] / 255
+    blended = base.astype(np.float32) * (1 - alpha) + np.array(color[:3], dtype=np.float32) * alpha
+    return blended.round().astype(np.uint8)
+
+
+def _ease_in_out(p: np.ndarray) -> np.ndarray:
+    # cubic ease-in-out on [0, 1]
+    return np.where(p < 0.5, 4 * p ** 3, 1 - (-2 * p + 2) ** 3 / 2)
+
+
+class AnimatedCompositor:
+    """Generates smoothly animated frames in vectorized batches.
+
+    The progress bar fills continuously over every segment and the highlight
+    box eases from the previous highlight to the next one. Every pixel of a
+    frame is either the base layer or the base blended with the highlight or
+    progress color, so both blended layers are computed once and each batch
+    of frames only selects between them with boolean masks.
+    """
+
+    def __init__(
+        self,
+        base: np.ndarray,
+        code_box: tuple[int, int],
+        segments: list[Segment],
+        fps: int = 30,
+        transition: float = 0.3,
+        highlight_color=(255, 0, 0, 26),
+        progress_color=(130, 56, 235, 77),
+        radius: int = 25,
+    ):
+        self.base = base
+        self.frame_h, self.frame_w = base.shape[:2]
+        self.code_x, self.code_w = code_box
+        self.segments = segments
+        self.fps = fps
+        self.transition = transition
+        self.radius = radius
+
+        self.highlighted = _blend(base, highlight_color)
+        self.progressed = _blend(base, progress_color)
+        self.progress_h = int(self.frame_h * 0.05)
+
+        durations = np.array([segment.duration for segment in segments], dtype=np.float64)
+        self.ends = np.cumsum(durations)
+        self.starts = self.ends - durations
+        self.durations = durations
+        self.frames_number = int(round(self.ends[-1] * fps))
+
+        self.tops = np.array(
+            [segment.box[0] if segment.box else 0 for segment in segments],
+            dtype=np.float32,
+        )
+        self.heights = np.array(
+            [segment.box[1] - segment.box[0] if segment.box else 0 for segment in segments],
+            dtype=np.float32,
+        )
+
+    def _box_geometry(self, seg: np.ndarray, t: np.ndarray):
+        visible = self.heights[seg] > 0
+        prev = np.maximum(seg - 1, 0)
+        # the first highlight after a box-less segment appears in place
+        moving = (seg > 0) & (self.heights[prev] > 0)
+
+        p = np.clip((t - self.starts[seg]) / self.transition, 0, 1)
+        p = np.where(moving, _ease_in_out(p), 1).astype(np.float32)
+
+        top = self.tops[prev] + (self.tops[seg] - self.tops[prev]) * p
+        height = self.heights[prev] + (self.heights[seg] - self.heights[prev]) * p
+        return visible, top, top + height
+
+    def _render_batch(self, frame_indices: np.ndarray) -> np.ndarray:
+        batch = len(frame_indices)
+        t = frame_indices / self.fps
+        seg = np.minimum(np.searchsorted(self.ends, t, side="right"), len(self.segments) - 1)
+
+        frames = np.repeat(self.base[None], batch, axis=0)
+
+        # progress bar, filling continuously within each segment
+        fraction = np.clip((t - self.starts[seg]) / self.durations[seg], 0, 1)
+        widths = self.code_w * (seg + fraction) / len(self.segments)
+        xs = np.arange(self.frame_w)
+        bar = xs[None, :] < widths[:, None]
+        frames[:, :self.progress_h] = np.where(
+            bar[:, None, :, None],
+            self.progressed[None, :self.progress_h],
+            frames[:, :self.progress_h],
+        )
+
+        # highlight box, only the rows it can cover in this batch are touched
+        visible, top, bottom = self._box_geometry(seg, t)
+        if not visible.any():
+            return frames
+
+        row_start = max(int(np.floor(top[visible].min())), 0)
+        row_end = min(int(np.ceil(bottom[visible].max())), self.frame_h)
+        col_start = max(self.code_x, 0)
+        col_end = min(self.code_x + self.code_w, self.frame_w)
+
+        ys = np.arange(row_start, row_end, dtype=np.float32)[None, :, None]
+        xs = np.arange(col_start, col_end, dtype=np.float32)[None, None, :]
+        top = top[:, None, None]
+        bottom = bottom[:, None, None]
+        r = self.radius
+
+        # distance into the rounded corners, zero along the straight edges
+        dy = np.maximum(np.maximum(top + r - ys, ys - (bottom - r)), 0)
+        dx = np.maximum(np.maximum(self.code_x + r - xs, xs - (self.code_x + self.code_w - r)), 0)
+        box = (
+            visible[:, None, None]
+            & (ys >= top) & (ys < bottom)
+            & (dx ** 2 + dy ** 2 <= r ** 2)
+        )
+
+        region = frames[:, row_start:row_end, col_start:col_end]
+        frames[:, row_start:row_end, col_start:col_end] = np.where(
+            box[..., None],
+            self.highlighted[None, row_start:row_end, col_start:col_end],
+            region,
+        )
+
+        return frames
+
+    def frames(self, batch_size: int = 8) -> Iterator[np.ndarray]:
+        """Yield (batch, height, width, 3) uint8 arrays covering the whole timeline."""
+        for start in range(0, self.frames_number, batch_size):
+            end = min(start + batch_size, self.frames_number)
+            yield self._render_batch(np.arange(start, end))
@@ -1,71 +1,330 @@
+import asyncio
+import concurrent.futures
+import contextvars
+import email.utils
+import functools
+import logging
 import os
-from dataclasses import dataclass
-import subprocess
+import random
 import tempfile
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Optional
 import uuid
 
 import dotenv
+import httpx
 import mutagen.mp3
 
-from elevenlabs import save
-from elevenlabs.client import ElevenLabs, DEFAULT_VOICE
+from elevenlabs.client import AsyncElevenLabs, ElevenLabs, DEFAULT_VOICE
+from elevenlabs.core import ApiError
+
+from src import tracing, tts_cache
 
 
 dotenv.load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+# Overrides the ElevenLabs API url, e.g. to point at a local fake TTS server.
+ELEVEN_BASE_URL = os.getenv("ELEVEN_BASE_URL")
+ELEVEN_MODEL = os.getenv("ELEVEN_MODEL", "eleven_monolingual_v1")
+# Maximum number of TTS requests in flight in generate_audio_batch.
+TTS_CONCURRENCY = int(os.getenv("TTS_CONCURRENCY", 4))
+TTS_MAX_RETRIES = 5
+# 429 (rate limited) and transient server errors are retried with backoff,
+# as are connection and read errors.
+RETRIABLE_STATUS_CODES = [429, 500, 502, 503, 504]
+# Longest Retry-After the server may ask us to wait, in seconds.
+TTS_MAX_RETRY_AFTER = 60
+# Seconds a TTS request may take, the SDK's default.
+TTS_TIMEOUT = 60
+
+
+class RetriableApiError(ApiError):
+    """A TTS response worth retrying, raised before the SDK reads its body."""
+
+    def __init__(self, status_code: int, retry_after: Optional[float] = None):
+        super().__init__(status_code=status_code, body=None)
+        self.retry_after = retry_after
+
 
 @dataclass
 class VoiceClip:
     text: str
     file_path: str
-    duration: int
+    duration: float
 
 
-def combine_audio_clips(voice_clips: list[VoiceClip]):
-    combined_path = f"./assets/audio/combined.mp3"
-    concat_file = "./assets/audio/concat.txt"
-    
-    # Write the list of audio files to a text file
-    with open(concat_file, "w+") as f:
-        for voice_clip in voice_clips:
-            # extract file name
-            file_name = os.path.basename(voice_clip.file_path)
-            f.write(f"file '{file_name}'\n")
-    
-    command = f"ffmpeg -f concat -safe 0 -i {concat_file} -c copy -y {combined_path}  -hide_banner -loglevel error"
-    subprocess.run(command, shell=True, check=True, capture_output=False)
-    
-    return combined_path
+def audio_input_args(voice_clips: list[VoiceClip], first_input: int = 1) -> list[str]:
+    """ffmpeg arguments joining the clips back to back into an `[audio]` stream.
+
+    Each clip is padded with silence or trimmed to exactly its recorded
+    duration, so the narration lines up with frames timed from the same
+    durations. `first_input` is the index the first clip gets among the
+    command's inputs.
+    """
+    args = []
+    filters = []
+    for idx, voice_clip in enumerate(voice_clips):
+        args += ["-i", voice_clip.file_path]
+        filters.append(
+            f"[{first_input + idx}:a]apad=whole_dur={voice_clip.duration},"
+            f"atrim=end={voice_clip.duration}[a{idx}]"
+        )
 
+    joined = "".join(f"[a{idx}]" for idx in range(len(voice_clips)))
+    filters.append(f"{joined}concat=n={len(voice_clips)}:v=0:a=1[audio]")
 
-def get_audio_length(file_path: str) -> int:
+    return args + ["-filter_complex", ";".join(filters)]
+
+
+def get_audio_length(file_path: str) -> float:
     audio = mutagen.mp3.MP3(file_path)
-    return int(audio.info.length) + 1
+    return audio.info.length
 
 
-def pad_audio_file(file_path: str, duration: int):
-    with tempfile.TemporaryDirectory() as tmpdir:
-        tmp_file = os.path.join(tmpdir, "tmp.mp3")
-        command = f"ffmpeg -y -i {file_path} -af apad=whole_dur={duration} {tmp_file}  -hide_banner -loglevel error"
-        subprocess.run(command, shell=True, check=True)
-        # move the padded file to the original file path
-        os.rename(tmp_file, file_path)
+def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds from a Retry-After header, given either as seconds or as a date."""
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
 
 
-def generate_audio(text: str, save_as: str) -> VoiceClip:
-    # if not os.path.exists(save_as):
-    client = ElevenLabs(
-        api_key=os.getenv("ELEVEN_API_KEY"),
+def _raise_retriable(response: httpx.Response):
+    # the SDK only exposes the status of a failed streaming response, not its headers
+    if response.status_code in RETRIABLE_STATUS_CODES:
+        raise RetriableApiError(response.status_code, _parse_retry_after(response.headers.get("retry-after")))
+
+
+async def _raise_retriable_async(response: httpx.Response):
+    _raise_retriable(response)
+
+
+def _client_options() -> dict:
+    options = {"api_key": os.getenv("ELEVEN_API_KEY")}
+    if ELEVEN_BASE_URL:
+        options["base_url"] = ELEVEN_BASE_URL
+    return options
+
+
+@functools.lru_cache(maxsize=1)
+def _get_client() -> ElevenLabs:
+    return ElevenLabs(
+        **_client_options(),
+        httpx_client=httpx.Client(timeout=TTS_TIMEOUT, event_hooks={"response": [_raise_retriable]}),
     )
-    voice = os.getenv("ELEVEN_VOICE", DEFAULT_VOICE)
-    output = client.generate(text=text, voice=voice)
-    save(output, save_as)
-    
+
+
+def _get_async_client(httpx_client: httpx.AsyncClient) -> AsyncElevenLabs:
+    return AsyncElevenLabs(**_client_options(), httpx_client=httpx_client)
+
+
+def _retry_delay(error: Exception, retry: int) -> Optional[float]:
+    """Seconds to wait before retrying a failed TTS request, None if it must not be retried."""
+    if retry == TTS_MAX_RETRIES:
+        return None
+    if isinstance(error, RetriableApiError) and error.retry_after is not None:
+        delay = min(error.retry_after, TTS_MAX_RETRY_AFTER)
+    elif isinstance(error, (RetriableApiError, httpx.TransportError)):
+        delay = random.random() * 2 ** (retry + 1)
+    else:
+        return None
+    logger.warning("TTS request failed (%r), retrying in %.1f seconds", error, delay)
+    return delay
+
+
+def _get_voice():
+    return os.getenv("ELEVEN_VOICE", DEFAULT_VOICE)
+
+
+def voice_clip_key(text: str) -> str:
+    """Identifies the audio synthesized for a text with the current voice settings."""
+    return tts_cache.cache_key(
+        text,
+        voice=_get_voice(),
+        model=ELEVEN_MODEL,
+        voice_settings=DEFAULT_VOICE.settings,
+    )
+
+
+def _to_voice_clip(text: str, save_as: str) -> VoiceClip:
     dur = get_audio_length(save_as)
-    pad_audio_file(save_as, dur)
+    tts_cache.put(voice_clip_key(text), save_as, dur)
     
     return VoiceClip(
         text=text,
         file_path=save_as,
         duration=dur,
     )
+
+
+def _from_cache(text: str, save_as: str) -> Optional[VoiceClip]:
+    dur = tts_cache.get(voice_clip_key(text), save_as)
+    if dur is None:
+        return None
+    return VoiceClip(text=text, file_path=save_as, duration=dur)
+
+
+def generate_audio(text: str, save_as: str) -> VoiceClip:
+    voice_clip = _from_cache(text, save_as)
+    if voice_clip is not None:
+        return voice_clip
+
+    client = _get_client()
+    for retry in range(TTS_MAX_RETRIES + 1):
+        try:
+            with tracing.span(os.path.basename(save_as), "tts", retry=retry) as span:
+                output = client.generate(text=text, voice=_get_voice(), model=ELEVEN_MODEL)
+                # written as the chunks arrive, a retry starts the file over
+                with open(save_as, "wb") as f:
+                    for chunk in output:
+                        span.bytes += f.write(chunk)
+            break
+        except Exception as e:
+            sleep_seconds = _retry_delay(e, retry)
+            if sleep_seconds is None:
+                raise
+            time.sleep(sleep_seconds)
+
+    return _to_voice_clip(text, save_as)
+
+
+class AudioPrefetcher:
+    """Synthesizes narration into the TTS cache while the script is still being written.
+
+    The audio stage then finds the clips in the cache, after waiting for the
+    ones still being synthesized when the prefetcher is passed to
+    generate_audio_batch. Clips are written to private temporary files,
+    never to the job's narration files, so texts that are dropped or
+    replaced later cost nothing but the request. Failures are only logged,
+    the audio stage synthesizes whatever is missing.
+    """
+
+    def __init__(self, concurrency: int = TTS_CONCURRENCY):
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=concurrency,
+            thread_name_prefix="tts-prefetch",
+        )
+        self.futures: dict[str, concurrent.futures.Future] = {}
+        self._lock = threading.Lock()
+
+    def add(self, text: str):
+        with self._lock:
+            if text in self.futures:
+                return
+            # the spans go to the tracer of the job that asked
+            context = contextvars.copy_context()
+            self.futures[text] = self.executor.submit(context.run, self._generate, text)
+
+    async def wait(self, text: str):
+        """Wait until the prefetch of text, if it was added, is done or dropped."""
+        future = self.futures.get(text)
+        if future is not None:
+            # never raises, _generate logs its errors
+            await asyncio.wait([asyncio.wrap_future(future)])
+
+    def _generate(self, text: str):
+        fd, tmp_path = tempfile.mkstemp(prefix="prefetch-", suffix=".mp3")
+        os.close(fd)
+        try:
+            generate_audio(text, tmp_path)
+        except Exception as e:
+            logger.warning("Prefetching narration %r failed: %s", text[:40], e)
+        finally:
+            os.remove(tmp_path)
+
+    def close(self):
+        # doesn't wait, requests already sent finish in the background and
+        # texts nobody waited for are dropped
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+async def _generate_audio_async(
+    client: AsyncElevenLabs,
+    semaphore: asyncio.Semaphore,
+    text: str,
+    save_as: str,
+) -> VoiceClip:
+    voice_clip = _from_cache(text, save_as)
+    if voice_clip is not None:
+        return voice_clip
+
+    async with semaphore:
+        for retry in range(TTS_MAX_RETRIES + 1):
+            try:
+                with tracing.span(os.path.basename(save_as), "tts", retry=retry) as span:
+                    output = await client.generate(text=text, voice=_get_voice(), model=ELEVEN_MODEL)
+                    # written as the chunks arrive, a retry starts the file over
+                    with open(save_as, "wb") as f:
+                        async for chunk in output:
+                            span.bytes += f.write(chunk)
+                break
+            except Exception as e:
+                sleep_seconds = _retry_delay(e, retry)
+                if sleep_seconds is None:
+                    raise
+                await asyncio.sleep(sleep_seconds)
+
+    # measuring and caching hit the disk, keep it off the event loop
+    return await asyncio.to_thread(_to_voice_clip, text, save_as)
+
+
+async def _generate_audio_batch(
+    items: list[tuple[str, str]],
+    concurrency: int,
+    on_clip: Optional[Callable[[int, VoiceClip], None]],
+    prefetcher: Optional[AudioPrefetcher],
+) -> list[VoiceClip]:
+    # One client for the whole batch so all requests share its connection pool.
+    httpx_client = httpx.AsyncClient(timeout=TTS_TIMEOUT, event_hooks={"response": [_raise_retriable_async]})
+    client = _get_async_client(httpx_client)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def generate(idx: int, text: str, save_as: str) -> VoiceClip:
+        if prefetcher is not None:
+            # a clip being prefetched is taken from the cache once it is done
+            await prefetcher.wait(text)
+        voice_clip = await _generate_audio_async(client, semaphore, text, save_as)
+        if on_clip is not None:
+            on_clip(idx, voice_clip)
+        return voice_clip
+
+    try:
+        return await asyncio.gather(*[
+            generate(idx, text, save_as)
+            for idx, (text, save_as) in enumerate(items)
+        ])
+    finally:
+        # a worker runs many batches, each must give back its connections
+        await httpx_client.aclose()
+
+
+def generate_audio_batch(
+    items: list[tuple[str, str]],
+    concurrency: int = TTS_CONCURRENCY,
+    on_clip: Optional[Callable[[int, VoiceClip], None]] = None,
+    prefetcher: Optional[AudioPrefetcher] = None,
+) -> list[VoiceClip]:
+    """Synthesize (text, save_as) pairs concurrently, preserving their order.
+
+    `on_clip(idx, voice_clip)` is called as soon as each clip is ready, in
+    completion order, so consumers can start on it before the batch is done.
+    Texts `prefetcher` is still synthesizing are waited for instead of
+    requested again.
+    """
+    return asyncio.run(_generate_audio_batch(items, concurrency, on_clip, prefetcher))
@@ -0,0 +1,260 @@
+import argparse
+import concurrent.futures
+import csv
+import json
+import logging
+import os
+import re
+import sys
+import threading
+from dataclasses import asdict, dataclass, field
+from typing import Callable, Iterable, Optional
+
+from src import tracing
+from src.build_graph import BuildGraph
+from src.main import generate_voice_clips, load_or_generate_script
+from src.script_processing import Script
+from src.video_processing import ENCODING_PROFILE, generate_video
+
+
+logger = logging.getLogger(__name__)
+
+
+STAGES = ("script", "audio", "video", "upload")
+
+# Default number of jobs each stage works on at the same time.
+DEFAULT_CONCURRENCY = {
+    "script": 4,
+    "audio": 4,
+    "video": 1,
+    "upload": 2,
+}
+
+
+@dataclass
+class BatchJob:
+    job_id: str
+    topic: str
+    library: str
+    title: str
+    keywords: str
+    description: str
+    work_dir: str
+    profile: str = ENCODING_PROFILE
+    script: Optional[Script] = None
+    graph: Optional[BuildGraph] = None
+    video_path: Optional[str] = None
+    video_id: Optional[str] = None
+    tracer: tracing.Tracer = field(default_factory=tracing.Tracer)
+
+
+def _slugify(text: str) -> str:
+    return re.sub(r"[^a-z0-9]+", "-", text.lower()).strip("-")[:40]
+
+
+def read_manifest(manifest_path: str, jobs_dir: str) -> list[BatchJob]:
+    """Read jobs from a CSV or JSONL manifest with topic, library, title and keywords.
+
+    An optional profile column picks the encoding profile, e.g. "draft" for previews.
+    """
+    with open(manifest_path, newline="") as f:
+        if manifest_path.endswith(".jsonl"):
+            rows = [json.loads(line) for line in f if line.strip()]
+        else:
+            rows = list(csv.DictReader(f))
+
+    return [job_from_row(row, f"{idx:04d}-{_slugify(row['title'])}", jobs_dir) for idx, row in enumerate(rows)]
+
+
+def job_from_row(row: dict, job_id: str, jobs_dir: str) -> BatchJob:
+    return BatchJob(
+        job_id=job_id,
+        topic=row["topic"],
+        library=row["library"],
+        title=row["title"],
+        keywords=row.get("keywords", ""),
+        description=row.get("description") or row["title"],
+        work_dir=os.path.join(jobs_dir, job_id),
+        profile=row.get("profile") or ENCODING_PROFILE,
+    )
+
+
+def _run_script_stage(job: BatchJob, upload: bool):
+    for subdir in ("audio", "images", "clips"):
+        os.makedirs(os.path.join(job.work_dir, subdir), exist_ok=True)
+    # rerunning a manifest only rebuilds what changed in each job
+    job.graph = BuildGraph(job.work_dir)
+    # no narration prefetch: the jobs already overlap, and every TTS request
+    # has to count against the audio stage's concurrency limit
+    job.script = load_or_generate_script(job.topic, job.library, job.work_dir, job.graph)
+
+
+def _run_audio_stage(job: BatchJob, upload: bool):
+    generate_voice_clips(job.script, job.work_dir, job.graph)
+
+
+def _run_video_stage(job: BatchJob, upload: bool):
+    job.video_path = generate_video(job.script, work_dir=job.work_dir, graph=job.graph, profile=job.profile)
+
+
+def _run_upload_stage(job: BatchJob, upload: bool):
+    if not upload:
+        logger.info("Skipping upload of %s", job.video_path)
+        return
+
+    from src.uploaders.youtube_uploader import UploadOptions, upload_to_youtube
+
+    options = UploadOptions(
+        file=job.video_path,
+        title=job.title,
+        description=job.description,
+        category="27",
+        keywords=job.keywords,
+        privacyStatus="public",
+    )
+    # rerunning a manifest must not publish the same video twice
+    video_key = job.graph.nodes.get("video", {}).get("key")
+    job.video_id = job.graph.build("upload", [video_key, asdict(options)], [], lambda: upload_to_youtube(options))
+
+
+STAGE_FUNCTIONS = {
+    "script": _run_script_stage,
+    "audio": _run_audio_stage,
+    "video": _run_video_stage,
+    "upload": _run_upload_stage,
+}
+
+
+def _run_stage(job: BatchJob, stage: str, upload: bool):
+    with tracing.use(job.tracer), tracing.span(stage, "stage", job=job.job_id):
+        STAGE_FUNCTIONS[stage](job, upload)
+
+
+def _write_trace(job: BatchJob):
+    try:
+        job.tracer.write(job.work_dir)
+    except OSError as e:
+        logger.warning("Failed to write trace of job %s: %s", job.job_id, e)
+
+
+def run_batch(
+    jobs: Iterable[BatchJob],
+    concurrency: Optional[dict[str, int]] = None,
+    upload: bool = False,
+    on_job_done: Optional[Callable[[BatchJob, Optional[BaseException]], None]] = None,
+    keep_results: bool = True,
+) -> dict[str, Optional[BaseException]]:
+    """Pipeline jobs through the stages, each stage with its own concurrency limit.
+
+    A job enters the next stage as soon as it leaves the previous one, so e.g.
+    rendering of one short overlaps with TTS and LLM calls of the following ones.
+    A job only enters a stage once the stage has room for it, until then it
+    keeps its place in the previous one, and the next job is only taken from
+    `jobs`, which may be a generator that blocks waiting for more, once the
+    script stage has room. So no job waits in a queue, e.g. a worker only
+    claims the queued jobs it can start on.
+    `on_job_done(job, error)` is called as each job finishes. Returns the
+    error of every job, None for jobs that succeeded; without
+    `keep_results` nothing is kept of finished jobs and the result is empty.
+    """
+    concurrency = {**DEFAULT_CONCURRENCY, **(concurrency or {})}
+    executors = {
+        stage: concurrent.futures.ThreadPoolExecutor(
+            max_workers=concurrency[stage],
+            thread_name_prefix=f"batch-{stage}",
+        )
+        for stage in STAGES
+    }
+    # jobs not finished yet, and the errors of finished ones when kept
+    pending: dict[str, concurrent.futures.Future] = {}
+    results: dict[str, Optional[BaseException]] = {}
+    lock = threading.Lock()
+    # a job holds a slot of its stage until the next stage has one for it
+    slots = {stage: threading.Semaphore(concurrency[stage]) for stage in STAGES}
+
+    def submit(job: BatchJob, stage_idx: int):
+        stage = STAGES[stage_idx]
+        future = executors[stage].submit(_run_stage, job, stage, upload)
+        future.add_done_callback(lambda f: on_stage_done(job, stage_idx, f))
+
+    def advance(job: BatchJob, stage_idx: int):
+        # runs in the finished stage's thread, which blocks until there is room
+        slots[STAGES[stage_idx + 1]].acquire()
+        slots[STAGES[stage_idx]].release()
+        submit(job, stage_idx + 1)
+
+    def finish(job: BatchJob, error: Optional[BaseException]):
+        _write_trace(job)
+        if on_job_done is not None:
+            try:
+                on_job_done(job, error)
+            except Exception:
+                logger.exception("Job %s done callback failed", job.job_id)
+        with lock:
+            if keep_results:
+                results[job.job_id] = error
+            future = pending.pop(job.job_id)
+        future.set_result(error)
+
+    def on_stage_done(job: BatchJob, stage_idx: int, future: concurrent.futures.Future):
+        error = future.exception()
+        if error is not None:
+            logger.error("Job %s failed in %s stage: %s", job.job_id, STAGES[stage_idx], error)
+            slots[STAGES[stage_idx]].release()
+            finish(job, error)
+        elif stage_idx + 1 < len(STAGES):
+            advance(job, stage_idx)
+        else:
+            logger.info("Job %s finished: %s", job.job_id, job.video_path)
+            slots[STAGES[stage_idx]].release()
+            finish(job, None)
+
+    try:
+        jobs = iter(jobs)
+        while True:
+            slots["script"].acquire()
+            job = next(jobs, None)
+            if job is None:
+                break
+            with lock:
+                pending[job.job_id] = concurrent.futures.Future()
+            submit(job, 0)
+        with lock:
+            unfinished = list(pending.values())
+        concurrent.futures.wait(unfinished)
+    finally:
+        for executor in executors.values():
+            executor.shutdown()
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate shorts for every topic in a manifest.")
+    parser.add_argument("manifest", help="CSV or JSONL file with topic, library, title and keywords")
+    parser.add_argument("--jobs-dir", default="./assets/jobs", help="directory for per-job working directories")
+    parser.add_argument("--upload", action="store_true", help="upload finished videos to YouTube")
+    for stage in STAGES:
+        parser.add_argument(
+            f"--{stage}-concurrency",
+            type=int,
+            default=DEFAULT_CONCURRENCY[stage],
+            help=f"number of jobs in the {stage} stage at the same time",
+        )
+    args = parser.parse_args()
+
+    jobs = read_manifest(args.manifest, args.jobs_dir)
+    errors = run_batch(
+        jobs,
+        concurrency={stage: getattr(args, f"{stage}_concurrency") for stage in STAGES},
+        upload=args.upload,
+    )
+
+    failed = [job_id for job_id, error in errors.items() if error is not None]
+    logger.info("%d of %d jobs succeeded", len(jobs) - len(failed), len(jobs))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
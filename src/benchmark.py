@@ -0,0 +1,220 @@
+"""Offline benchmark of the whole pipeline.
+
+The LLMs, PyPI and ElevenLabs are replaced by deterministic local stubs, so
+the numbers only measure our own work (parsing, compositing, encoding, muxing)
+and can be compared between commits on a machine without network access:
+
+    python -m src.benchmark --highlights 5 20 50 --lines 10 25 --output bench.json
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import functools
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+from dataclasses import asdict, dataclass
+
+from src import audio_processing, ffmpeg_runner, main, script_processing, tracing, tts_cache
+from src.build_graph import BuildGraph
+from src.llms import router
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class BenchmarkCase:
+    highlights: int
+    lines: int
+    mode: str
+    profile: str
+    workers: int
+    clip_seconds: float
+    tts_latency: float
+
+
+class StubLLM:
+    """Answers the description, code and highlights prompts like a well-behaved model."""
+
+    def __init__(self, lines: int, highlights: int):
+        self.lines = lines
+        self.highlights = highlights
+
+    def __call__(self, prompt: str, temperature=0.3, max_tokens=1024, use_cache=True) -> str:
+        if prompt.startswith("I'm creating a youtube video"):
+            return "Here's how to benchmark a shorts generator in 60 seconds"
+
+        if "Please write a code snippet" in prompt:
+            code = "\n".join(f"value_{idx} = compute({idx}, step={idx % 7})" for idx in range(self.lines))
+            return f"```python\n{code}\n```"
+
+        rows = [
+            f'{idx % self.lines + 1}|{idx % self.lines + 1}|"Step {idx} of the example computes one value"'
+            for idx in range(self.highlights)
+        ]
+        return "```csv\nstart_line_number|end_line_number|description_of_the_block\n" + "\n".join(rows) + "\n```"
+
+    def stream(self, prompt: str, temperature=0.3, max_tokens=1024, use_cache=True):
+        response = self(prompt, temperature, max_tokens)
+        # about the size of a streamed token
+        for start in range(0, len(response), 4):
+            yield response[start:start + 4]
+
+
+@functools.lru_cache(maxsize=None)
+def silent_mp3(seconds: float) -> bytes:
+    return ffmpeg_runner.run(
+        ["-f", "lavfi", "-i", "anullsrc=r=44100:cl=mono", "-t", str(seconds), "-q:a", "9", "-f", "mp3", "-"],
+        "silent mp3",
+        capture_output=True,
+    )
+
+
+class StubTTS:
+    """Stands in for both ElevenLabs clients, streaming a silent mp3 in chunks."""
+
+    chunk_size = 4096
+
+    def __init__(self, clip_seconds: float, latency: float):
+        self.audio = silent_mp3(clip_seconds)
+        self.latency = latency
+
+    def _chunks(self):
+        for start in range(0, len(self.audio), self.chunk_size):
+            yield self.audio[start:start + self.chunk_size]
+
+    def generate(self, text: str, voice=None, model=None):
+        time.sleep(self.latency)
+        return self._chunks()
+
+
+class StubAsyncTTS(StubTTS):
+    async def _async_chunks(self):
+        for chunk in self._chunks():
+            yield chunk
+
+    async def generate(self, text: str, voice=None, model=None):
+        await asyncio.sleep(self.latency)
+        return self._async_chunks()
+
+
+def _install_stubs(case: BenchmarkCase, cache_dir: str):
+    llm = StubLLM(case.lines, case.highlights)
+    router.set_router(router.Router({name: router.Backend(name, llm, llm.stream) for name in ("openai", "groq")}))
+    script_processing.fetch_documentation = lambda library: f"{library} documentation"
+
+    audio_processing._get_client = lambda: StubTTS(case.clip_seconds, case.tts_latency)
+    audio_processing.AsyncElevenLabs = lambda **options: StubAsyncTTS(case.clip_seconds, case.tts_latency)
+    # every case starts with a cold TTS cache
+    tts_cache.TTS_CACHE_DIR = cache_dir
+
+    main.DRY_RUN = True
+
+
+def _peak_rss_mb(who: int) -> float:
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+def run_case(case: BenchmarkCase) -> dict:
+    """Generate one short; meant to run in a fresh process so peak memory is its own."""
+    logging.getLogger().setLevel(logging.WARNING)
+
+    with tempfile.TemporaryDirectory(prefix="shorts-bench-") as tmp_dir:
+        work_dir = os.path.join(tmp_dir, "job")
+        for subdir in ("audio", "images", "clips"):
+            os.makedirs(os.path.join(work_dir, subdir))
+        _install_stubs(case, os.path.join(tmp_dir, "tts"))
+
+        tracer = tracing.Tracer()
+        start = time.perf_counter()
+        with tracing.use(tracer):
+            video_path = main.run(
+                topic="Benchmarking",
+                library="benchmark",
+                title="Benchmark",
+                description="Benchmark",
+                graph=BuildGraph(work_dir),
+                work_dir=work_dir,
+                mode=case.mode,
+                profile=case.profile,
+            )
+        seconds = time.perf_counter() - start
+        video_bytes = os.path.getsize(video_path)
+
+    summary = tracer.summary()
+    video_seconds = (case.highlights + 1) * case.clip_seconds
+    return {
+        **asdict(case),
+        "seconds": seconds,
+        "stages": {span.name: span.duration for span in tracer.spans if span.category == "stage"},
+        "render_seconds": summary.get("render", {}).get("seconds", 0.0),
+        "ffmpeg_seconds": summary.get("ffmpeg", {}).get("seconds", 0.0),
+        "ffmpeg_cpu_seconds": summary.get("ffmpeg", {}).get("subprocess_cpu", 0.0),
+        "video_seconds": video_seconds,
+        "realtime_factor": video_seconds / seconds,
+        "video_bytes": video_bytes,
+        "peak_rss_mb": _peak_rss_mb(resource.RUSAGE_SELF),
+        "children_peak_rss_mb": _peak_rss_mb(resource.RUSAGE_CHILDREN),
+    }
+
+
+def run_benchmark(cases: list[BenchmarkCase]) -> list[dict]:
+    results = []
+    for case in cases:
+        logger.info("Benchmarking %s", case)
+        # read by video_processing when the case's process imports it
+        os.environ["RENDER_WORKERS"] = str(case.workers)
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=1,
+            mp_context=multiprocessing.get_context("spawn"),
+        ) as executor:
+            result = executor.submit(run_case, case).result()
+        logger.info(
+            "%d highlights, %d lines, %s, %s: %.2fs (%.1fx realtime), peak %.0f MB",
+            case.highlights,
+            case.lines,
+            case.mode,
+            case.profile,
+            result["seconds"],
+            result["realtime_factor"],
+            result["peak_rss_mb"],
+        )
+        results.append(result)
+    return results
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline offline with stub LLM and TTS backends.")
+    parser.add_argument("--highlights", type=int, nargs="+", default=[5, 20, 50], help="highlights per script")
+    parser.add_argument("--lines", type=int, nargs="+", default=[10, 25], help="lines of code per script")
+    parser.add_argument("--modes", nargs="+", default=["single_pass"], help="render modes to compare")
+    parser.add_argument("--profiles", nargs="+", default=["final"], help="encoding profiles to compare")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="render worker processes")
+    parser.add_argument("--clip-seconds", type=float, default=3.0, help="length of every stub voice clip")
+    parser.add_argument("--tts-latency", type=float, default=0.0, help="seconds every stub TTS request takes")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO)
+    cases = [
+        BenchmarkCase(highlights, lines, mode, profile, args.workers, args.clip_seconds, args.tts_latency)
+        for highlights, lines, mode, profile in itertools.product(
+            args.highlights, args.lines, args.modes, args.profiles,
+        )
+    ]
+    results = run_benchmark(cases)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main_cli()
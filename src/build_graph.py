@@ -0,0 +1,68 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+def hash_inputs(inputs) -> str:
+    payload = json.dumps(inputs, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class BuildGraph:
+    """Tracks which artifacts of a job are up to date.
+
+    Every node (e.g. "voice:3" or "clip:intro") is recorded with a hash of
+    the inputs it was built from and the files it produced. A node is stale
+    when its inputs hash differently or one of its outputs is missing, and
+    only stale nodes need to be rebuilt. Nodes depending on other nodes
+    include the upstream inputs in their own, so a change propagates down.
+    The state is kept in build.json inside the job's working directory.
+    """
+
+    def __init__(self, work_dir: str):
+        self.path = os.path.join(work_dir, "build.json")
+        self._lock = threading.Lock()
+        try:
+            with open(self.path) as f:
+                self.nodes = json.load(f)
+        except (OSError, ValueError):
+            self.nodes = {}
+
+    def is_fresh(self, name: str, inputs) -> bool:
+        node = self.nodes.get(name)
+        return (
+            node is not None
+            and node["key"] == hash_inputs(inputs)
+            and all(os.path.exists(path) for path in node["outputs"])
+        )
+
+    def result(self, name: str):
+        return self.nodes[name].get("result")
+
+    def record(self, name: str, inputs, outputs: list[str], result=None):
+        with self._lock:
+            self.nodes[name] = {
+                "key": hash_inputs(inputs),
+                "outputs": outputs,
+                "result": result,
+            }
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.nodes, f, indent=2)
+            os.replace(tmp_path, self.path)
+
+    def build(self, name: str, inputs, outputs: list[str], func):
+        """Return the recorded result of a fresh node, otherwise run func and record it."""
+        if self.is_fresh(name, inputs):
+            logger.info("%s is up to date", name)
+            return self.result(name)
+
+        logger.info("Building %s", name)
+        result = func()
+        self.record(name, inputs, outputs, result)
+        return result
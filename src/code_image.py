@@ -0,0 +1,232 @@
+import functools
+import logging
+import os
+import string
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+import PIL.Image
+import PIL.ImageDraw
+import PIL.ImageFont
+from pygments.lexers import PythonLexer
+from pygments.style import Style
+from pygments.token import (
+    Keyword,
+    Name,
+    Comment,
+    String,
+    Error,
+    Number,
+    Operator,
+    Generic,
+    Punctuation,
+)
+
+
+logger = logging.getLogger(__name__)
+
+# shipped with the code, so it doesn't depend on the working directory
+FONTS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "assets", "fonts")
+# (bold, italic) -> font file
+FONT_FILES = {
+    (False, False): "CourierPrime-Regular.ttf",
+    (True, False): "CourierPrime-Bold.ttf",
+    (False, True): "CourierPrime-Italic.ttf",
+    (True, True): "CourierPrime-BoldItalic.ttf",
+}
+FONT_SIZE = 40
+# Same spacing as Pygments' ImageFormatter defaults.
+LINE_PAD = 2
+IMAGE_PAD = 10
+
+
+class SimpleStyle(Style):
+    default_style = ""
+    background_color = "#212121"
+    styles = {
+        Comment: "italic #888",
+        Keyword: "#2e95d3",
+        Name: "#fff",
+        Name.Function: "#e9950c",
+        Name.Class: "bold #0f0",
+        String: "#ba2121",
+        Error: "bg:#F00 #FFF",
+        Number: "#df3079",
+        Operator: "#fff",
+        Punctuation: "#fff",
+        Generic.Output: "#888",
+    }
+
+
+@dataclass(frozen=True)
+class LineBox:
+    """Where the ink of one line of code can be, in pixels of the code image."""
+    left: int
+    top: int
+    right: int
+    bottom: int
+
+
+@dataclass
+class CodeImage:
+    pixels: np.ndarray
+    # one box per line of code, all of the same height
+    line_boxes: list[LineBox]
+    line_height: int
+
+    @property
+    def width(self) -> int:
+        return self.pixels.shape[1]
+
+    @property
+    def height(self) -> int:
+        return self.pixels.shape[0]
+
+    def to_image(self) -> PIL.Image.Image:
+        return PIL.Image.fromarray(self.pixels)
+
+    def line_span(self, line_number: int, line_count: int) -> Optional[tuple[int, int]]:
+        """Top and bottom of lines [line_number, line_number + line_count), None if they are not in the image."""
+        if line_count <= 0 or not self.line_boxes:
+            return None
+        last = len(self.line_boxes) - 1
+        first = min(max(line_number, 0), last)
+        end = min(max(line_number + line_count - 1, first), last)
+        return self.line_boxes[first].top, self.line_boxes[end].bottom
+
+
+def _rgb(color: str) -> np.ndarray:
+    color = color.lstrip("#")
+    if len(color) == 3:
+        color = "".join(c * 2 for c in color)
+    return np.array([int(color[idx:idx + 2], 16) for idx in (0, 2, 4)], dtype=np.float32)
+
+
+@dataclass
+class Glyph:
+    # offset of the mask from the top left corner of the character cell
+    x: int
+    y: int
+    alpha: np.ndarray
+    # color premultiplied by alpha
+    color: np.ndarray
+
+
+class GlyphAtlas:
+    """Glyphs of one monospace font, size and style, rasterized once.
+
+    Every (character, token style) pair is kept as a coverage mask and the
+    matching premultiplied color, so drawing a character is one
+    alpha blend of a small array into the image.
+    """
+
+    def __init__(self, style: type[Style], font_size: int, fonts_dir: str):
+        self.style = style
+        self.fonts = {
+            variant: PIL.ImageFont.truetype(os.path.join(fonts_dir, file_name), font_size)
+            for variant, file_name in FONT_FILES.items()
+        }
+        # the character cell is measured like Pygments does, on "M"
+        self.char_w, self.char_h = self.fonts[(False, False)].getbbox("M")[2:4]
+        self.line_height = self.char_h + LINE_PAD
+        # vertical extent of the ink of any line, relative to the line's top
+        _, self.ink_top, _, self.ink_bottom = self.fonts[(False, False)].getbbox(string.printable.strip())
+        self.background = _rgb(style.background_color)
+        self._glyphs: dict[tuple, Optional[Glyph]] = {}
+
+    def token_style(self, ttype) -> tuple:
+        style = self.style.style_for_token(ttype)
+        return (
+            style["color"] or "000",
+            style["bgcolor"],
+            bool(style["bold"]),
+            bool(style["italic"]),
+        )
+
+    def glyph(self, char: str, color: str, bold: bool, italic: bool) -> Optional[Glyph]:
+        """The glyph of char in the given style, None for blank characters."""
+        key = (char, color, bold, italic)
+        if key not in self._glyphs:
+            self._glyphs[key] = self._rasterize(*key)
+        return self._glyphs[key]
+
+    def _rasterize(self, char: str, color: str, bold: bool, italic: bool) -> Optional[Glyph]:
+        font = self.fonts[(bold, italic)]
+        left, top, right, bottom = font.getbbox(char)
+        if right <= left or bottom <= top:
+            return None
+
+        mask = PIL.Image.new("L", (right - left, bottom - top), 0)
+        PIL.ImageDraw.Draw(mask).text((-left, -top), char, font=font, fill=255)
+        alpha = np.asarray(mask, dtype=np.float32)[..., None] / 255
+        return Glyph(x=left, y=top, alpha=alpha, color=alpha * _rgb(color))
+
+
+@functools.lru_cache(maxsize=8)
+def get_atlas(style: type[Style] = SimpleStyle, font_size: int = FONT_SIZE, fonts_dir: str = FONTS_DIR) -> GlyphAtlas:
+    logger.info("Building glyph atlas")
+    return GlyphAtlas(style, font_size, fonts_dir)
+
+
+@functools.lru_cache(maxsize=1)
+def get_lexer() -> PythonLexer:
+    return PythonLexer()
+
+
+def render_code(code: str, atlas: GlyphAtlas = None) -> CodeImage:
+    """Syntax highlight code by blending glyphs from the atlas onto a monospace grid."""
+    atlas = atlas or get_atlas()
+
+    placements = []
+    line_lengths = [0]
+    for ttype, value in get_lexer().get_tokens(code):
+        style = atlas.token_style(ttype)
+        for char in value.expandtabs(4):
+            if char == "\n":
+                line_lengths.append(0)
+                continue
+            placements.append((len(line_lengths) - 1, line_lengths[-1], char, style))
+            line_lengths[-1] += 1
+    # the lexer ends the code with a newline, which doesn't start a line
+    if line_lengths[-1] == 0:
+        line_lengths.pop()
+
+    width = max(line_lengths, default=0) * atlas.char_w + 2 * IMAGE_PAD
+    height = len(line_lengths) * atlas.line_height + 2 * IMAGE_PAD
+    pixels = np.empty((height, width, 3), dtype=np.float32)
+    pixels[:] = atlas.background
+
+    # backgrounds first, glyphs overhanging into a neighbouring cell stay visible
+    for row, col, char, (color, bgcolor, bold, italic) in placements:
+        if bgcolor:
+            y = IMAGE_PAD + row * atlas.line_height
+            x = IMAGE_PAD + col * atlas.char_w
+            pixels[y:y + atlas.line_height, x:x + atlas.char_w] = _rgb(bgcolor)
+
+    for row, col, char, (color, bgcolor, bold, italic) in placements:
+        glyph = atlas.glyph(char, color, bold, italic)
+        if glyph is None:
+            continue
+        y = IMAGE_PAD + row * atlas.line_height + glyph.y
+        x = IMAGE_PAD + col * atlas.char_w + glyph.x
+        # glyphs of the last line and column may be cut by the image border
+        h = min(glyph.alpha.shape[0], height - y)
+        w = min(glyph.alpha.shape[1], width - x)
+        target = pixels[y:y + h, x:x + w]
+        target *= 1 - glyph.alpha[:h, :w]
+        target += glyph.color[:h, :w]
+
+    return CodeImage(
+        pixels=pixels.round().astype(np.uint8),
+        line_boxes=[
+            LineBox(
+                left=IMAGE_PAD,
+                top=IMAGE_PAD + row * atlas.line_height + atlas.ink_top,
+                right=IMAGE_PAD + length * atlas.char_w,
+                bottom=IMAGE_PAD + row * atlas.line_height + atlas.ink_bottom,
+            )
+            for row, length in enumerate(line_lengths)
+        ],
+        line_height=atlas.line_height,
+    )
@@ -0,0 +1,130 @@
+import functools
+import json
+import logging
+import os
+import re
+import tempfile
+import time
+from typing import Callable
+
+
+logger = logging.getLogger(__name__)
+
+# Overridable to point at a local stand-in for PyPI.
+PYPI_URL = os.getenv("PYPI_URL", "https://pypi.org/pypi")
+DOCS_CACHE_DIR = os.getenv("DOCS_CACHE_DIR", "./assets/cache/docs")
+# Cached documentation younger than this is used without asking PyPI at all,
+# older entries are revalidated with a conditional request.
+DOCS_CACHE_MAX_AGE = int(os.getenv("DOCS_CACHE_MAX_AGE", 24 * 3600))
+# Approximate number of prompt tokens the documentation may take up.
+DOCS_TOKEN_BUDGET = int(os.getenv("DOCS_TOKEN_BUDGET", 2000))
+REQUEST_TIMEOUT = 10
+
+# Rough average for English prose and markdown.
+CHARS_PER_TOKEN = 4
+
+
+@functools.lru_cache(maxsize=1)
+def _get_session():
+    # requests is only imported once the cache can't answer
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_maxsize=16))
+    session.mount("http://", HTTPAdapter(pool_maxsize=16))
+    return session
+
+
+def truncate_to_budget(text: str, token_budget: int) -> str:
+    """Keep whole paragraphs from the start of the text until the budget is used up."""
+    max_chars = token_budget * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text
+
+    result = ""
+    for paragraph in re.split(r"\n\s*\n", text):
+        if len(result) + len(paragraph) + 2 > max_chars:
+            break
+        result += paragraph + "\n\n"
+
+    # a single huge first paragraph is cut mid-way rather than dropped
+    return result.strip() or text[:max_chars]
+
+
+def _cache_path(library: str) -> str:
+    return os.path.join(DOCS_CACHE_DIR, f"{library}.json")
+
+
+def _read_cache(library: str):
+    try:
+        with open(_cache_path(library)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_cache(library: str, entry: dict):
+    os.makedirs(DOCS_CACHE_DIR, exist_ok=True)
+    # a temporary file per writer, jobs may fetch the same library at once
+    fd, tmp_path = tempfile.mkstemp(dir=DOCS_CACHE_DIR, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, _cache_path(library))
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def _fetch_description(library: str) -> str:
+    cached = _read_cache(library)
+    if cached is not None and time.time() - cached["fetched_at"] < DOCS_CACHE_MAX_AGE:
+        return cached["description"]
+
+    headers = {}
+    if cached is not None:
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+
+    import requests
+
+    logger.info("Fetching documentation for library: %s", library)
+    try:
+        response = _get_session().get(f"{PYPI_URL}/{library}/json", headers=headers, timeout=REQUEST_TIMEOUT)
+        if response.status_code == 304 and cached is not None:
+            logger.info("Documentation for %s not modified", library)
+            description = cached["description"]
+        else:
+            response.raise_for_status()
+            description = response.json()["info"]["description"]
+    except (requests.RequestException, ValueError, KeyError) as e:
+        if cached is None:
+            raise
+        # stale documentation is better than failing the job, the next one revalidates again
+        logger.warning("Revalidating documentation for %s failed, using the cached copy: %s", library, e)
+        return cached["description"]
+
+    _write_cache(library, {
+        "description": description,
+        "etag": response.headers.get("ETag") or (cached or {}).get("etag"),
+        "last_modified": response.headers.get("Last-Modified") or (cached or {}).get("last_modified"),
+        "fetched_at": time.time(),
+    })
+
+    return description
+
+
+def fetch_documentation(
+    library: str,
+    token_budget: int = DOCS_TOKEN_BUDGET,
+    truncate: Callable[[str, int], str] = truncate_to_budget,
+) -> str:
+    """Return the PyPI description of a library, shortened to fit the prompt.
+
+    `truncate` receives the full description and the token budget; swap it
+    for e.g. an LLM summarizer to keep more than the first paragraphs.
+    """
+    return truncate(_fetch_description(library), token_budget)
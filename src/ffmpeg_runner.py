@@ -0,0 +1,335 @@
+"""Runs ffmpeg processes without a shell, a limited number at a time.
+
+Commands are argument lists, so paths with spaces or quotes need no
+escaping. Every process holds one of FFMPEG_CONCURRENCY slots for its
+lifetime. The slots are lock files shared by every process on the machine,
+so render workers, batch jobs and separate workers all count against the
+same limit, and the kernel frees a slot when its holder dies. ffmpeg's
+`-progress` reports are parsed into a `Progress`, and the trace span of the
+process gets its exact CPU time.
+
+On Windows the limit only holds within each process, and neither progress
+nor CPU time is recorded.
+"""
+import asyncio
+import contextlib
+import logging
+import os
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+from src import tracing
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+logger = logging.getLogger(__name__)
+
+# ffmpeg processes running at the same time on this machine.
+FFMPEG_CONCURRENCY = int(os.getenv("FFMPEG_CONCURRENCY", os.cpu_count() or 1))
+# Directory of the slot lock files; processes sharing it share the limit.
+FFMPEG_LOCK_DIR = os.getenv("FFMPEG_LOCK_DIR", os.path.join(tempfile.gettempdir(), "shorts-ffmpeg"))
+# Seconds an ffmpeg process may run before it is killed, 0 for no limit.
+FFMPEG_TIMEOUT = float(os.getenv("FFMPEG_TIMEOUT", 1800))
+# Seconds between looks for a free slot while all are taken.
+SLOT_POLL_INTERVAL = 0.05
+# Lines of ffmpeg's error output kept for the exception of a failed process.
+STDERR_TAIL_LINES = 20
+
+# Without lock files (on Windows), the slots of this process.
+_local_slots = threading.BoundedSemaphore(FFMPEG_CONCURRENCY)
+# Passing ffmpeg a pipe for its progress and reaping it with wait4 are POSIX only.
+_POSIX = os.name == "posix"
+
+
+class FFmpegCancelled(Exception):
+    """The process was cancelled before it started."""
+
+
+class FFmpegError(subprocess.CalledProcessError):
+    """ffmpeg exited with an error; `stderr` holds the last lines it logged."""
+
+    def __str__(self):
+        message = super().__str__()
+        return f"{message}\n{self.stderr}" if self.stderr else message
+
+
+@dataclass
+class Progress:
+    """The latest `-progress` report of an ffmpeg process."""
+    frame: int = 0
+    fps: float = 0.0
+    # seconds of output written so far
+    out_time: float = 0.0
+    # seconds of output written per second of encoding
+    speed: float = 0.0
+    total_size: int = 0
+    done: bool = False
+
+    def update(self, key: str, value: str):
+        try:
+            if key == "frame":
+                self.frame = int(value)
+            elif key == "fps":
+                self.fps = float(value)
+            elif key == "out_time_us":
+                self.out_time = int(value) / 1e6
+            elif key == "speed":
+                self.speed = float(value.rstrip("x"))
+            elif key == "total_size":
+                self.total_size = int(value)
+            elif key == "progress":
+                self.done = value == "end"
+        except ValueError:
+            # "N/A" until the first frame is written
+            pass
+
+
+@contextlib.contextmanager
+def slot(cancel: Optional[threading.Event] = None):
+    """Hold one of the machine's FFMPEG_CONCURRENCY ffmpeg slots.
+
+    Raises FFmpegCancelled if `cancel` is set while waiting for one.
+    """
+    cancel = cancel or threading.Event()
+    if fcntl is None:
+        while not _local_slots.acquire(timeout=SLOT_POLL_INTERVAL):
+            if cancel.is_set():
+                raise FFmpegCancelled()
+        try:
+            yield
+        finally:
+            _local_slots.release()
+        return
+
+    os.makedirs(FFMPEG_LOCK_DIR, exist_ok=True)
+    while not cancel.is_set():
+        for idx in range(FFMPEG_CONCURRENCY):
+            fd = os.open(os.path.join(FFMPEG_LOCK_DIR, f"slot-{idx}.lock"), os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+            try:
+                yield
+            finally:
+                # closing the file releases the lock
+                os.close(fd)
+            return
+        cancel.wait(SLOT_POLL_INTERVAL)
+    raise FFmpegCancelled()
+
+
+class FFmpegProcess:
+    """One ffmpeg process, started as soon as a slot is free.
+
+    `args` are ffmpeg's arguments without the executable and logging
+    options. With `stdin=True` input is sent with `write`; with
+    `capture_output=True`, `wait` returns what ffmpeg wrote to stdout.
+    `on_progress` gets every progress report, from a separate thread. The
+    process is killed after `timeout` seconds, or by `cancel`. Setting the
+    `cancel_event` while waiting for a slot raises FFmpegCancelled instead
+    of starting ffmpeg.
+    """
+
+    def __init__(
+        self,
+        args: list[str],
+        name: str,
+        stdin: bool = False,
+        capture_output: bool = False,
+        output_path: Optional[str] = None,
+        timeout: float = FFMPEG_TIMEOUT,
+        on_progress: Optional[Callable[[Progress], None]] = None,
+        cancel_event: Optional[threading.Event] = None,
+    ):
+        self.name = name
+        self.output_path = output_path
+        self.capture_output = capture_output
+        self.timeout = timeout
+        self.on_progress = on_progress
+        self.progress = Progress()
+        self.timed_out = False
+        self._stderr = deque(maxlen=STDERR_TAIL_LINES)
+        self._lock = threading.Lock()
+
+        self._exit_stack = contextlib.ExitStack()
+        try:
+            queued_at = time.perf_counter()
+            self._exit_stack.enter_context(slot(cancel_event))
+            self.span = self._exit_stack.enter_context(tracing.span(name, "ffmpeg"))
+            self.span.args["queued"] = time.perf_counter() - queued_at
+            self._start(args, stdin)
+        except BaseException:
+            self._exit_stack.close()
+            raise
+
+    def _start(self, args: list[str], stdin: bool):
+        self.command = ["ffmpeg", "-hide_banner", "-nostats", "-loglevel", "error"]
+        progress_read = progress_write = None
+        if _POSIX:
+            progress_read, progress_write = os.pipe()
+            self.command += ["-progress", f"pipe:{progress_write}"]
+        self.command += list(args)
+        try:
+            self.process = subprocess.Popen(
+                self.command,
+                stdin=subprocess.PIPE if stdin else subprocess.DEVNULL,
+                stdout=subprocess.PIPE if self.capture_output else None,
+                stderr=subprocess.PIPE,
+                pass_fds=(progress_write,) if _POSIX else (),
+            )
+        except BaseException:
+            if _POSIX:
+                os.close(progress_read)
+            raise
+        finally:
+            if _POSIX:
+                os.close(progress_write)
+
+        self._threads = [threading.Thread(target=self._read_stderr, daemon=True)]
+        if _POSIX:
+            self._threads.append(threading.Thread(target=self._read_progress, args=(progress_read,), daemon=True))
+        for thread in self._threads:
+            thread.start()
+        self._timer = None
+        if self.timeout:
+            self._timer = threading.Timer(self.timeout, self._on_timeout)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _read_progress(self, fd: int):
+        with open(fd, "rb") as f:
+            for line in f:
+                key, _, value = line.decode(errors="replace").strip().partition("=")
+                self.progress.update(key, value)
+                if key == "progress":
+                    logger.debug(
+                        "%s: frame %d, %.2fs written, %.2fx",
+                        self.name, self.progress.frame, self.progress.out_time, self.progress.speed,
+                    )
+                    if self.on_progress is not None:
+                        self.on_progress(self.progress)
+
+    def _read_stderr(self):
+        for line in self.process.stderr:
+            self._stderr.append(line.decode(errors="replace").rstrip())
+
+    def _on_timeout(self):
+        logger.error("Killing %s after %ss", self.name, self.timeout)
+        self.timed_out = True
+        self.kill()
+
+    def kill(self):
+        with self._lock:
+            # a reaped process's pid may already belong to another one
+            if self.process.returncode is None:
+                if _POSIX:
+                    os.kill(self.process.pid, signal.SIGKILL)
+                else:
+                    self.process.kill()
+
+    def _reap(self):
+        if self.process.returncode is not None:
+            return
+        if not _POSIX:
+            self.process.wait()
+            return
+        # wait without reaping, so kill never signals a reused pid
+        os.waitid(os.P_PID, self.process.pid, os.WEXITED | os.WNOWAIT)
+        with self._lock:
+            _, status, usage = os.wait4(self.process.pid, 0)
+            self.process.returncode = os.waitstatus_to_exitcode(status)
+        # only this process, unlike the children CPU time of concurrent spans
+        self.span.subprocess_cpu = usage.ru_utime + usage.ru_stime
+
+    def _error(self) -> subprocess.SubprocessError:
+        stderr = "\n".join(self._stderr)
+        if self.timed_out:
+            return subprocess.TimeoutExpired(self.command, self.timeout, stderr=stderr)
+        return FFmpegError(self.process.returncode, self.command, stderr=stderr)
+
+    def write(self, data: bytes):
+        try:
+            self.process.stdin.write(data)
+        except BrokenPipeError:
+            # ffmpeg exited early, report why instead
+            self.cancel()
+            raise self._error() from None
+
+    def wait(self) -> Optional[bytes]:
+        """Wait for ffmpeg to exit; returns its output when captured.
+
+        Raises FFmpegError if it failed and subprocess.TimeoutExpired if it
+        was killed for taking too long. Interrupting the wait kills ffmpeg.
+        """
+        try:
+            if self.process.stdin is not None:
+                with contextlib.suppress(BrokenPipeError):
+                    self.process.stdin.close()
+            output = self.process.stdout.read() if self.capture_output else None
+            self._reap()
+        finally:
+            self.cancel()
+
+        if self.process.returncode != 0:
+            raise self._error()
+        self.span.args.update(frames=self.progress.frame, speed=self.progress.speed)
+        if self.output_path is not None:
+            self.span.bytes = os.path.getsize(self.output_path)
+        elif output is not None:
+            self.span.bytes = len(output)
+        return output
+
+    def cancel(self):
+        """Kill ffmpeg unless it already exited and give back its slot."""
+        self.kill()
+        self._reap()
+        if self._timer is not None:
+            self._timer.cancel()
+        for thread in self._threads:
+            thread.join()
+        self._exit_stack.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.cancel()
+
+
+def run(args: list[str], name: str, **kwargs) -> Optional[bytes]:
+    """Run ffmpeg to completion; see FFmpegProcess for the arguments."""
+    return FFmpegProcess(args, name, **kwargs).wait()
+
+
+async def run_async(args: list[str], name: str, **kwargs) -> Optional[bytes]:
+    """`run` from asyncio code. Cancelling the task kills ffmpeg, or gives up
+    waiting for a slot if it hasn't started yet."""
+    cancel_event = threading.Event()
+    starting = asyncio.ensure_future(asyncio.to_thread(FFmpegProcess, args, name, cancel_event=cancel_event, **kwargs))
+    try:
+        process = await asyncio.shield(starting)
+    except asyncio.CancelledError:
+        cancel_event.set()
+        # it may have got a slot and started just now
+        starting.add_done_callback(lambda future: future.cancelled() or future.exception() or future.result().cancel())
+        raise
+    waiting = asyncio.ensure_future(asyncio.to_thread(process.wait))
+    try:
+        return await asyncio.shield(waiting)
+    except asyncio.CancelledError:
+        process.kill()
+        # the killed process's error is expected
+        waiting.add_done_callback(lambda future: future.exception())
+        raise
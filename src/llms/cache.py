@@ -0,0 +1,242 @@
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Iterator, Optional
+
+from src import tracing
+
+
+logger = logging.getLogger(__name__)
+
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "./assets/cache/llm.sqlite")
+# Seconds a cached response stays valid, 0 disables the on-disk cache.
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", 7 * 24 * 3600))
+# Least recently used responses are evicted past this many entries.
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", 10000))
+
+# Requests currently being made, so concurrent identical prompts share one call.
+_in_flight: dict[str, concurrent.futures.Future] = {}
+_in_flight_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def _connect():
+    os.makedirs(os.path.dirname(LLM_CACHE_PATH) or ".", exist_ok=True)
+    connection = sqlite3.connect(LLM_CACHE_PATH, timeout=30)
+    try:
+        # commits on success, rolls back on error
+        with connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, "
+                "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            yield connection
+    finally:
+        connection.close()
+
+
+def _cache_key(backend: str, model: str, prompt: str, temperature: float, max_tokens: int) -> str:
+    payload = json.dumps([backend, model, prompt, temperature, max_tokens])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _get(key: str):
+    now = time.time()
+    with _connect() as connection:
+        row = connection.execute(
+            "SELECT response FROM responses WHERE key = ? AND created_at > ?",
+            (key, now - LLM_CACHE_TTL),
+        ).fetchone()
+        if row is not None:
+            connection.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+    return row[0] if row is not None else None
+
+
+def _put(key: str, response: str):
+    now = time.time()
+    with _connect() as connection:
+        connection.execute(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+            (key, response, now, now),
+        )
+        connection.execute("DELETE FROM responses WHERE created_at <= ?", (now - LLM_CACHE_TTL,))
+        connection.execute(
+            "DELETE FROM responses WHERE key NOT IN "
+            "(SELECT key FROM responses ORDER BY accessed_at DESC LIMIT ?)",
+            (LLM_CACHE_MAX_ENTRIES,),
+        )
+
+
+def _delete(key: str):
+    with _connect() as connection:
+        connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+
+
+def forget(backend: str, model: str, prompt: str, temperature=0.3, max_tokens=1024):
+    """Drop a cached response, e.g. one that turned out to be unusable."""
+    if LLM_CACHE_TTL <= 0:
+        return
+    try:
+        _delete(_cache_key(backend, model, prompt, temperature, max_tokens))
+    except sqlite3.Error as e:
+        logger.warning("Failed to drop LLM response from cache: %s", e)
+
+
+def _lookup(key: str, backend: str, model: str, span) -> Optional[str]:
+    if LLM_CACHE_TTL <= 0:
+        return None
+    try:
+        response = _get(key)
+    except sqlite3.Error as e:
+        logger.warning("LLM cache lookup failed: %s", e)
+        return None
+    if response is not None:
+        logger.info("LLM cache hit for %s/%s", backend, model)
+        span.args["cache"] = "hit"
+    return response
+
+
+def _claim(key: str) -> tuple[concurrent.futures.Future, bool]:
+    """The future of the request for key and whether the caller has to make it."""
+    with _in_flight_lock:
+        future = _in_flight.get(key)
+        owner = future is None
+        if owner:
+            future = concurrent.futures.Future()
+            _in_flight[key] = future
+    return future, owner
+
+
+def _release(key: str):
+    with _in_flight_lock:
+        del _in_flight[key]
+
+
+def _store(key: str, response: str):
+    if LLM_CACHE_TTL <= 0:
+        return
+    try:
+        _put(key, response)
+    except sqlite3.Error as e:
+        logger.warning("Failed to store LLM response in cache: %s", e)
+
+
+def cached(backend: str, model: str):
+    """Memoize an `invoke(prompt, temperature, max_tokens)` backend function.
+
+    The wrapper takes `use_cache=False` to ask the backend even if the
+    prompt was answered before, without caching the answer, and gets a
+    `forget(prompt, temperature, max_tokens)` attribute dropping one.
+    """
+    def decorator(invoke):
+        def call(span, prompt: str, temperature: float, max_tokens: int) -> str:
+            key = _cache_key(backend, model, prompt, temperature, max_tokens)
+
+            response = _lookup(key, backend, model, span)
+            if response is not None:
+                return response
+
+            future, owner = _claim(key)
+            if not owner:
+                logger.info("Waiting for identical in-flight %s/%s request", backend, model)
+                span.args["cache"] = "in_flight"
+                return future.result()
+
+            span.args["cache"] = "miss"
+            try:
+                response = invoke(prompt, temperature=temperature, max_tokens=max_tokens)
+            except BaseException as e:
+                future.set_exception(e)
+                raise
+            else:
+                # stored before it stops being in flight, so an identical
+                # request always finds one or the other
+                _store(key, response)
+                future.set_result(response)
+            finally:
+                _release(key)
+
+            return response
+
+        @functools.wraps(invoke)
+        def wrapper(prompt: str, temperature=0.3, max_tokens=1024, use_cache=True) -> str:
+            with tracing.span(f"{backend}/{model}", "llm") as span:
+                if use_cache:
+                    response = call(span, prompt, temperature, max_tokens)
+                else:
+                    span.args["cache"] = "skip"
+                    response = invoke(prompt, temperature=temperature, max_tokens=max_tokens)
+                span.bytes = len(response.encode("utf-8"))
+            return response
+
+        wrapper.forget = functools.partial(forget, backend, model)
+        return wrapper
+    return decorator
+
+
+def cached_stream(backend: str, model: str):
+    """Memoize an `invoke_stream(prompt, temperature, max_tokens)` backend generator.
+
+    Shares its cache with `cached`: a cached or identical in-flight response
+    is yielded as a single chunk, a new one chunk by chunk as it arrives.
+    Takes `use_cache` like the `cached` wrapper.
+    """
+    def decorator(invoke_stream):
+        @functools.wraps(invoke_stream)
+        def wrapper(prompt: str, temperature=0.3, max_tokens=1024, use_cache=True) -> Iterator[str]:
+            with tracing.span(f"{backend}/{model}", "llm", stream=True) as span:
+                if not use_cache:
+                    span.args["cache"] = "skip"
+                    for chunk in invoke_stream(prompt, temperature=temperature, max_tokens=max_tokens):
+                        span.bytes += len(chunk.encode("utf-8"))
+                        yield chunk
+                    return
+
+                key = _cache_key(backend, model, prompt, temperature, max_tokens)
+
+                response = _lookup(key, backend, model, span)
+                if response is None:
+                    future, owner = _claim(key)
+                    if not owner:
+                        logger.info("Waiting for identical in-flight %s/%s request", backend, model)
+                        span.args["cache"] = "in_flight"
+                        response = future.result()
+
+                if response is not None:
+                    span.bytes = len(response.encode("utf-8"))
+                    yield response
+                    return
+
+                span.args["cache"] = "miss"
+                chunks = []
+                try:
+                    for chunk in invoke_stream(prompt, temperature=temperature, max_tokens=max_tokens):
+                        chunks.append(chunk)
+                        span.bytes += len(chunk.encode("utf-8"))
+                        yield chunk
+                except GeneratorExit:
+                    # the consumer stopped early, waiters must not hang
+                    future.set_exception(RuntimeError(f"{backend}/{model} stream closed before the end"))
+                    raise
+                except BaseException as e:
+                    future.set_exception(e)
+                    raise
+                else:
+                    response = "".join(chunks)
+                    # stored before it stops being in flight, like in cached
+                    _store(key, response)
+                    future.set_result(response)
+                finally:
+                    _release(key)
+
+        wrapper.forget = functools.partial(forget, backend, model)
+        return wrapper
+    return decorator
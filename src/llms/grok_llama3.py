@@ -1,17 +1,33 @@
+import functools
 import os
+from typing import Iterator
 from dotenv import load_dotenv
-from groq import Groq
+
+from src.llms.cache import cached, cached_stream
 
 load_dotenv()
 
-client = Groq(
-    api_key=os.getenv("GROK_API_KEY"),
-)
+MODEL = "llama3-8b-8192"
+# Seconds a request may take, so a hung one fails over instead of running
+# for the SDK's default of 10 minutes.
+REQUEST_TIMEOUT = float(os.getenv("LLM_REQUEST_TIMEOUT", 120))
+
+
+@functools.lru_cache(maxsize=1)
+def _get_client():
+    # imported and created on first use, like the OpenAI client
+    from groq import Groq
+
+    return Groq(
+        api_key=os.getenv("GROK_API_KEY"),
+        timeout=REQUEST_TIMEOUT,
+    )
 
 
+@cached("groq", MODEL)
 def invoke(prompt: str, temperature=0.3, max_tokens=1024) -> str:
-    completion = client.chat.completions.create(
-        model="llama3-8b-8192",
+    completion = _get_client().chat.completions.create(
+        model=MODEL,
         messages=[
             {
                 "role": "user",
@@ -26,3 +42,25 @@ def invoke(prompt: str, temperature=0.3, max_tokens=1024) -> str:
     )
 
     return completion.choices[0].message.content
+
+
+@cached_stream("groq", MODEL)
+def invoke_stream(prompt: str, temperature=0.3, max_tokens=1024) -> Iterator[str]:
+    completion = _get_client().chat.completions.create(
+        model=MODEL,
+        messages=[
+            {
+                "role": "user",
+                "content": prompt,
+            }
+        ],
+        temperature=temperature,
+        max_tokens=max_tokens,
+        top_p=1,
+        stream=True,
+        stop=None,
+    )
+
+    for chunk in completion:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
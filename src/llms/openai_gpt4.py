@@ -1,25 +1,41 @@
+import functools
 import os
+from typing import Iterator
 from dotenv import load_dotenv
-from openai import OpenAI
+
+from src.llms.cache import cached, cached_stream
 
 
 load_dotenv()
 
 
-client = OpenAI(
-    api_key=os.environ.get("OPENAI_API_KEY"),
-)
+MODEL = "gpt-4-turbo"
+# Seconds a request may take, so a hung one fails over instead of running
+# for the SDK's default of 10 minutes.
+REQUEST_TIMEOUT = float(os.getenv("LLM_REQUEST_TIMEOUT", 120))
+
+@functools.lru_cache(maxsize=1)
+def _get_client():
+    # imported and created on first use, jobs that never call this backend
+    # don't pay for the SDK import nor need its API key
+    from openai import OpenAI
 
+    return OpenAI(
+        api_key=os.environ.get("OPENAI_API_KEY"),
+        timeout=REQUEST_TIMEOUT,
+    )
 
+
+@cached("openai", MODEL)
 def invoke(prompt: str, temperature=0.3, max_tokens=1024) -> str:
-    chat_completion = client.chat.completions.create(
+    chat_completion = _get_client().chat.completions.create(
         messages=[
             {
                 "role": "user",
                 "content": prompt,
             }
         ],
-        model="gpt-4-turbo",
+        model=MODEL,
         temperature=temperature,
         max_tokens=max_tokens,
         top_p=1,
@@ -28,3 +44,26 @@ def invoke(prompt: str, temperature=0.3, max_tokens=1024) -> str:
     )
 
     return chat_completion.choices[0].message.content
+
+
+@cached_stream("openai", MODEL)
+def invoke_stream(prompt: str, temperature=0.3, max_tokens=1024) -> Iterator[str]:
+    chat_completion = _get_client().chat.completions.create(
+        messages=[
+            {
+                "role": "user",
+                "content": prompt,
+            }
+        ],
+        model=MODEL,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        top_p=1,
+        stream=True,
+        stop=None,
+    )
+
+    for chunk in chat_completion:
+        # the last chunks only carry the finish reason
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
@@ -0,0 +1,303 @@
+import concurrent.futures
+import contextvars
+import functools
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Generator, Iterator, Optional, TypeVar
+
+
+logger = logging.getLogger(__name__)
+
+# Preferred backends of every step, best first, optionally followed by the
+# step's latency target in seconds and cost limit, e.g.
+# "description=openai,groq@latency=5;code=groq,openai@latency=20,max_cost=1".
+LLM_ROUTES = os.getenv("LLM_ROUTES", "")
+# Seconds without an answer (or, when streaming, a first chunk) before the
+# next backend is asked as well; the first answer wins. 0 disables hedging.
+LLM_HEDGE_AFTER = float(os.getenv("LLM_HEDGE_AFTER", 15))
+# Seconds a backend that failed is ranked behind the ones that didn't.
+LLM_FAILURE_COOLDOWN = 60
+# Weight of the newest sample in a backend's moving average latency.
+LATENCY_SMOOTHING = 0.3
+
+T = TypeVar("T")
+
+
+class LLMError(RuntimeError):
+    """Every backend of a step failed."""
+
+
+@dataclass
+class Backend:
+    # invoke and invoke_stream take (prompt, temperature, max_tokens, use_cache)
+    name: str
+    invoke: Callable[..., str]
+    # a generator, so a stream that lost a race can be closed
+    invoke_stream: Callable[..., Generator[str, None, None]]
+    # USD per million prompt tokens, only compared between backends
+    cost: float = 0.0
+    # drops the cached answer to (prompt, temperature, max_tokens)
+    forget: Optional[Callable[..., None]] = None
+
+
+@dataclass
+class Route:
+    backends: list[str]
+    # backends whose average latency is above this are ranked last
+    latency_target: float
+    # backends pricier than this are only used when the others fail
+    max_cost: Optional[float] = None
+
+
+DEFAULT_ROUTES = {
+    "description": Route(["openai", "groq"], latency_target=5),
+    "code": Route(["groq", "openai"], latency_target=20),
+    "highlights": Route(["openai", "groq"], latency_target=20),
+}
+
+
+def default_backends() -> dict[str, Backend]:
+    from src.llms import grok_llama3, openai_gpt4
+
+    return {
+        "openai": Backend(
+            "openai", openai_gpt4.invoke, openai_gpt4.invoke_stream, cost=10.0, forget=openai_gpt4.invoke.forget,
+        ),
+        "groq": Backend(
+            "groq", grok_llama3.invoke, grok_llama3.invoke_stream, cost=0.05, forget=grok_llama3.invoke.forget,
+        ),
+    }
+
+
+def routes_from_env(spec: str = LLM_ROUTES) -> dict[str, Route]:
+    """DEFAULT_ROUTES with the routes of `spec` (see LLM_ROUTES) replacing theirs."""
+    routes = dict(DEFAULT_ROUTES)
+    for entry in filter(None, spec.split(";")):
+        step, _, rest = entry.partition("=")
+        step = step.strip()
+        backends, _, options = rest.partition("@")
+        default = routes.get(step, Route([], latency_target=20))
+        route = Route(
+            [name.strip() for name in backends.split(",") if name.strip()],
+            latency_target=default.latency_target,
+            max_cost=default.max_cost,
+        )
+        for option in filter(None, options.split(",")):
+            key, _, value = option.partition("=")
+            if key.strip() == "latency":
+                route.latency_target = float(value)
+            elif key.strip() == "max_cost":
+                route.max_cost = float(value)
+            else:
+                raise ValueError(f"Unknown option {key.strip()!r} in LLM route of {step}")
+        routes[step] = route
+    return routes
+
+
+class Router:
+    """Sends each step's prompts to the best available backend.
+
+    Backends are tried in the route's order, except that ones over the
+    route's cost limit, slower on average than its latency target or that
+    failed recently are moved to the back. Latency is the time until the
+    whole answer arrived, also when it is streamed, averaged per step and
+    backend. A request that takes longer than `hedge_after` is also sent to
+    the next backend, and a failed one goes on to the next backend right
+    away. Either way its backend counts as failed from then on, without
+    waiting for a hung request to end.
+    """
+
+    def __init__(
+        self,
+        backends: dict[str, Backend],
+        routes: Optional[dict[str, Route]] = None,
+        hedge_after: float = LLM_HEDGE_AFTER,
+    ):
+        self.backends = backends
+        self.routes = routes if routes is not None else routes_from_env()
+        self.hedge_after = hedge_after
+        # moving average seconds per (step, backend name)
+        self.latency: dict[tuple[str, str], float] = {}
+        self.failed_at: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def candidates(self, step: str) -> list[Backend]:
+        route = self.routes[step]
+        now = time.monotonic()
+
+        def rank(idx: int, name: str):
+            backend = self.backends[name]
+            latency = self.latency.get((step, name))
+            over_budget = route.max_cost is not None and backend.cost > route.max_cost
+            slow = latency is not None and latency > route.latency_target
+            failing = now - self.failed_at.get(name, -LLM_FAILURE_COOLDOWN) < LLM_FAILURE_COOLDOWN
+            # the slow ones are ordered by how slow they are
+            return over_budget, failing, slow, latency if slow else idx
+
+        with self._lock:
+            names = [name for name in route.backends if name in self.backends]
+            return [self.backends[name] for _, name in sorted(enumerate(names), key=lambda item: rank(*item))]
+
+    def _record(self, step: str, backend: Backend, seconds: float):
+        key = step, backend.name
+        with self._lock:
+            previous = self.latency.get(key, seconds)
+            self.latency[key] = previous + LATENCY_SMOOTHING * (seconds - previous)
+
+    def _record_failure(self, backend: Backend):
+        with self._lock:
+            self.failed_at[backend.name] = time.monotonic()
+
+    def _race(
+        self,
+        step: str,
+        call: Callable[[Backend], T],
+        on_lost: Optional[Callable[[T], None]] = None,
+        timed: bool = True,
+    ) -> T:
+        """Return call(backend) of the first backend to answer, hedging and failing over.
+
+        `on_lost` gets the results of requests that answered too late. Unless
+        `timed` is False, e.g. when call only waits for the start of the
+        answer, the time calls took is recorded as the backends' latency.
+        """
+        candidates = self.candidates(step)
+        if not candidates:
+            raise LLMError(f"No LLM backend configured for {step}")
+        pending: dict[concurrent.futures.Future, tuple[Backend, float]] = {}
+        errors = []
+
+        def launch():
+            backend = candidates.pop(0)
+            pending[_submit(call, backend)] = backend, time.perf_counter()
+
+        def late(backend: Backend, start: float, future: concurrent.futures.Future):
+            # a lost race still tells how fast the backend is
+            if future.exception() is not None:
+                self._record_failure(backend)
+                return
+            if timed:
+                self._record(step, backend, time.perf_counter() - start)
+            if on_lost is not None:
+                on_lost(future.result())
+
+        launch()
+        while pending:
+            hedge = self.hedge_after > 0 and candidates
+            done, _ = concurrent.futures.wait(
+                pending,
+                timeout=self.hedge_after if hedge else None,
+                return_when=concurrent.futures.FIRST_COMPLETED,
+            )
+            if not done:
+                logger.warning("No answer for %s after %ss, also asking %s", step, self.hedge_after, candidates[0].name)
+                # the next requests go elsewhere first, even if this one never ends
+                for backend, _ in pending.values():
+                    self._record_failure(backend)
+                launch()
+                continue
+
+            for future in done:
+                backend, start = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.warning("%s failed for %s: %s", backend.name, step, e)
+                    self._record_failure(backend)
+                    errors.append(e)
+                    if candidates:
+                        launch()
+                    continue
+
+                if timed:
+                    self._record(step, backend, time.perf_counter() - start)
+                for loser, (loser_backend, loser_start) in pending.items():
+                    loser.add_done_callback(functools.partial(late, loser_backend, loser_start))
+                return result
+
+        raise LLMError(f"Every backend failed for {step}: {errors}") from errors[-1]
+
+    def invoke(self, step: str, prompt: str, temperature=0.3, max_tokens=1024, use_cache=True) -> str:
+        return self._race(
+            step,
+            lambda backend: backend.invoke(prompt, temperature=temperature, max_tokens=max_tokens, use_cache=use_cache),
+        )
+
+    def invoke_stream(self, step: str, prompt: str, temperature=0.3, max_tokens=1024, use_cache=True) -> Iterator[str]:
+        """Stream the answer of the first backend to send a chunk.
+
+        Hedging and failover only happen before that first chunk; an error
+        in the middle of a stream is raised to the caller.
+        """
+        def start(backend: Backend) -> tuple[Backend, float, str, Generator[str, None, None]]:
+            started_at = time.perf_counter()
+            chunks = backend.invoke_stream(prompt, temperature=temperature, max_tokens=max_tokens, use_cache=use_cache)
+            return backend, started_at, next(chunks, ""), chunks
+
+        def close(started: tuple[Backend, float, str, Generator[str, None, None]]):
+            started[3].close()
+
+        # the race only waits for the first chunk, the latency is recorded
+        # once the whole answer arrived, like invoke's
+        backend, started_at, first, chunks = self._race(step, start, on_lost=close, timed=False)
+        try:
+            yield first
+            yield from chunks
+        except Exception:
+            self._record_failure(backend)
+            raise
+        else:
+            self._record(step, backend, time.perf_counter() - started_at)
+        finally:
+            chunks.close()
+
+    def forget(self, step: str, prompt: str, temperature=0.3, max_tokens=1024):
+        """Drop the cached answers of the step's backends to a prompt, e.g. after they were rejected."""
+        for name in self.routes[step].backends:
+            backend = self.backends.get(name)
+            if backend is not None and backend.forget is not None:
+                backend.forget(prompt, temperature=temperature, max_tokens=max_tokens)
+
+
+def _submit(call: Callable[[Backend], T], backend: Backend) -> concurrent.futures.Future:
+    """Run call(backend) in a thread of its own.
+
+    Not in a pool: a hung request that lost its race must not hold up the
+    requests after it. The request's spans go to the tracer of the job that
+    made it, and answers that arrive too late still get cached.
+    """
+    future = concurrent.futures.Future()
+    context = contextvars.copy_context()
+
+    def run():
+        try:
+            result = context.run(call, backend)
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+    threading.Thread(target=run, name=f"llm-{backend.name}", daemon=True).start()
+    return future
+
+
+_router: Optional[Router] = None
+_router_lock = threading.Lock()
+
+
+def get_router() -> Router:
+    global _router
+    with _router_lock:
+        if _router is None:
+            _router = Router(default_backends())
+        return _router
+
+
+def set_router(router: Router):
+    """Replace the router script generation uses, e.g. with one over fake backends."""
+    global _router
+    with _router_lock:
+        _router = router
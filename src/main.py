@@ -1,9 +1,12 @@
 
 import logging
-from src.audio_processing import generate_audio
-from src.video_processing import generate_video
-from src.script_processing import generate_script
-from src.uploaders.youtube_uploader import UploadOptions, upload_to_youtube
+import os
+from typing import Callable, Optional
+from src import tracing
+from src.audio_processing import AudioPrefetcher, VoiceClip, generate_audio_batch, voice_clip_key
+from src.build_graph import BuildGraph
+from src.video_processing import ENCODING_PROFILE, RENDER_MODE, StreamingClipRenderer, generate_video
+from src.script_processing import Script, generate_script, load_script, save_script
 
 
 root_logger = logging.getLogger()
@@ -19,36 +22,163 @@ logger = logging.getLogger(__name__)
 DRY_RUN = True
 
 
+def narration_path(work_dir: str, idx: int) -> str:
+    """Where the narration of the intro (index 0) or of highlight i (index i + 1) is saved."""
+    audio_dir = os.path.join(work_dir, "audio")
+    if idx == 0:
+        return os.path.join(audio_dir, "intro.mp3")
+    return os.path.join(audio_dir, f"voice_{idx - 1}.mp3")
+
+
+def _generate_script(topic: str, library: str, prefetcher: Optional[AudioPrefetcher]) -> Script:
+    if prefetcher is None:
+        return generate_script(topic, library)
+
+    # the highlights stream in, each is synthesized while the next is written
+    return generate_script(topic, library, on_narration=lambda idx, text: prefetcher.add(text))
+
+
+def load_or_generate_script(
+    topic: str,
+    library: str,
+    work_dir: str = "./assets",
+    graph: Optional[BuildGraph] = None,
+    prefetcher: Optional[AudioPrefetcher] = None,
+) -> Script:
+    """Generate the script, or reuse the saved one if its inputs are unchanged.
+
+    With a prefetcher, the narration of a new script is synthesized into the
+    TTS cache as it is written; passing the same prefetcher to
+    generate_voice_clips picks it up from there.
+    """
+    if graph is None:
+        return _generate_script(topic, library, prefetcher)
+
+    # the saved script is reused even after manual edits, so fixing a
+    # highlight only rebuilds what depends on it
+    script_path = os.path.join(work_dir, "script.json")
+    inputs = [topic, library]
+    if graph.is_fresh("script", inputs):
+        logger.info("Reusing script %s", script_path)
+        return load_script(script_path)
+
+    script = _generate_script(topic, library, prefetcher)
+    save_script(script, script_path)
+    graph.record("script", inputs, [script_path])
+    return script
+
+
+def generate_voice_clips(
+    script: Script,
+    work_dir: str = "./assets",
+    graph: Optional[BuildGraph] = None,
+    on_clip: Optional[Callable[[int, VoiceClip], None]] = None,
+    prefetcher: Optional[AudioPrefetcher] = None,
+):
+    """Synthesize the narration of the intro (index 0) and every highlight (index i + 1).
+
+    `on_clip(idx, voice_clip)` is called as soon as each clip is available.
+    Clips `prefetcher` is still synthesizing are waited for one by one.
+    """
+    items = [
+        ("voice:intro", script.intro_text, narration_path(work_dir, 0)),
+    ] + [
+        (f"voice:{idx}", code_block.text, narration_path(work_dir, idx + 1))
+        for idx, code_block in enumerate(script.highlights)
+    ]
+
+    voice_clips = [None] * len(items)
+    stale = []
+    for idx, (name, text, path) in enumerate(items):
+        if graph is not None and graph.is_fresh(name, voice_clip_key(text)):
+            voice_clips[idx] = VoiceClip(text=text, file_path=path, duration=graph.result(name))
+            if on_clip is not None:
+                on_clip(idx, voice_clips[idx])
+        else:
+            stale.append(idx)
+
+    def on_generated(stale_idx: int, voice_clip: VoiceClip):
+        idx = stale[stale_idx]
+        voice_clips[idx] = voice_clip
+        if graph is not None:
+            graph.record(items[idx][0], voice_clip_key(voice_clip.text), [voice_clip.file_path], voice_clip.duration)
+        if on_clip is not None:
+            on_clip(idx, voice_clip)
+
+    if stale:
+        generate_audio_batch(
+            [(items[idx][1], items[idx][2]) for idx in stale],
+            on_clip=on_generated,
+            prefetcher=prefetcher,
+        )
+
+    script.intro_text_voide_clip = voice_clips[0]
+    
+    for code_block, voice_clip in zip(script.highlights, voice_clips[1:]):
+        code_block.voice_clip = voice_clip
+
+
 def main():
     title = "Using elevenlabs to generate audio from text"
     description = "A video about using elevenlabs to generate audio from text"
     topic = "Using elevenlabs to generate audio from text"
     library = "elevenlabs"
 
-    script = generate_script(topic, library)
-
-    voice_clip = generate_audio(script.intro_text, "./assets/audio/intro.mp3")
-    script.intro_text_voide_clip = voice_clip
-    
-    for idx, code_block in enumerate(script.highlights):
-        voice_file = f"./assets/audio/voice_{idx}.mp3"
-        voice_clip = generate_audio(code_block.text, voice_file)
-        code_block.voice_clip = voice_clip
-
-
-    video_path = generate_video(script)
-
-    opts = UploadOptions(
-        file=video_path,
-        title=title,
-        description=description,
-        category="27",
-        keywords="elevenlabs,audio,text,code,python,programming,tutorial",
-        privacyStatus="public",
-    )
+    graph = BuildGraph("./assets")
+    tracer = tracing.Tracer()
+
+    try:
+        with tracing.use(tracer):
+            run(topic, library, title, description, graph)
+    finally:
+        # trace.json has per-category totals, trace.chrome.json opens in Perfetto
+        tracer.write("./assets")
+
+
+def run(
+    topic: str,
+    library: str,
+    title: str,
+    description: str,
+    graph: BuildGraph,
+    work_dir: str = "./assets",
+    mode: str = RENDER_MODE,
+    profile: str = ENCODING_PROFILE,
+) -> str:
+    # the narration synthesized while the script is written is handed on to
+    # the audio stage, which only waits for the clips it doesn't have yet
+    with AudioPrefetcher() as prefetcher:
+        with tracing.span("script", "stage"):
+            script = load_or_generate_script(topic, library, work_dir, graph, prefetcher=prefetcher)
+
+        if mode == "streaming":
+            # clips are rendered while the remaining narration is synthesized
+            with tracing.span("audio+video", "stage"):
+                with StreamingClipRenderer(script, work_dir=work_dir, graph=graph, profile=profile) as renderer:
+                    generate_voice_clips(script, work_dir, graph, on_clip=renderer.add, prefetcher=prefetcher)
+                    video_path = renderer.finish()
+        else:
+            with tracing.span("audio", "stage"):
+                generate_voice_clips(script, work_dir, graph, prefetcher=prefetcher)
+            with tracing.span("video", "stage"):
+                video_path = generate_video(script, mode=mode, work_dir=work_dir, graph=graph, profile=profile)
 
     if not DRY_RUN:
-        upload_to_youtube(opts)
+        # the Google API client is only imported by runs that upload
+        from src.uploaders.youtube_uploader import UploadOptions, upload_to_youtube
+
+        opts = UploadOptions(
+            file=video_path,
+            title=title,
+            description=description,
+            category="27",
+            keywords="elevenlabs,audio,text,code,python,programming,tutorial",
+            privacyStatus="public",
+        )
+        with tracing.span("upload", "stage"):
+            upload_to_youtube(opts)
+
+    return video_path
 
 
 
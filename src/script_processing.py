@@ -1,22 +1,41 @@
+import asyncio
+import functools
+import json
 import os
 import logging
-from dataclasses import dataclass
+import re
+import time
+from dataclasses import asdict, dataclass, field
 from pprint import pprint
-from typing import Optional
+from typing import Callable, Iterable, Iterator, Optional, TypeVar
 
-import black
 from dotenv import load_dotenv
-import requests
 
+from src import tracing
 from src.audio_processing import VoiceClip
-from src.llms import openai_gpt4 as gpt4
-from src.llms import grok_llama3 as llama3
+from src.documentation import fetch_documentation
+from src.llms.router import get_router
 
 
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
+# 42 characters of the code font fill the width of the frame.
+MAX_LINE_LENGTH = 42
+MAX_CODE_LINES = 25
+# How many times a step whose output fails validation is asked again.
+LLM_VALIDATION_RETRIES = int(os.getenv("LLM_VALIDATION_RETRIES", 2))
+
+
+class ScriptValidationError(ValueError):
+    """A model's output that the rest of the pipeline can't use."""
+
+    def __init__(self, message: str, output: str = ""):
+        super().__init__(message)
+        # the rejected output, shown to the model when it is asked again
+        self.output = output
+
 
 @dataclass
 class ScriptCodeHighlight:
@@ -33,6 +52,8 @@ class Script:
     highlights: list[ScriptCodeHighlight]
     cta_text: str
     intro_text_voide_clip: Optional[VoiceClip] = None
+    # seconds spent in each generation step
+    timings: dict[str, float] = field(default_factory=dict)
 
 
 PROMPT_DESCRIPTION_GENERATION = """I'm creating a youtube video about this topic:
@@ -103,6 +124,16 @@ start_line_number|end_line_number|description_of_the_block
 ```
 """
 
+PROMPT_RETRY = """{prompt}
+--- Your previous answer:
+{output}
+--- It was rejected because:
+{error}
+---
+Please answer again, fixing these problems and following all of the rules above.
+"""
+
+
 def _annote_line_numbers(code: str) -> str:
     lines = code.split("\n")
     annotated_lines = [f"{idx + 1}: {line}" for idx, line in enumerate(lines)]
@@ -113,101 +144,264 @@ def _generate_topic_description(topic: str) -> str:
     logger.info("Generating description for topic: %s", topic)
     prompt = PROMPT_DESCRIPTION_GENERATION.format(topic)
 
-    description = gpt4.invoke(prompt, temperature=1.0)
+    description = get_router().invoke("description", prompt, temperature=1.0)
     print(description)
 
     return description
 
 
 def _fetch_documentation(library: str) -> str:
-    logger.info("Fetching documentation for library: %s", library)
-    url = f"https://pypi.org/pypi/{library}/json"
+    return fetch_documentation(library)
 
-    response = requests.get(url)
-    data = response.json()
 
-    return data["info"]["description"]
+@functools.lru_cache(maxsize=1)
+def _black_mode():
+    import black
 
+    return black.Mode(line_length=MAX_LINE_LENGTH)
 
-def _generate_code(topic: str, description: str, library: str) -> str:
-    logger.info(f"Generating code for topic: {topic}")
-    documentation = _fetch_documentation(library)
-    prompt = PROMPT_CODE_GENERATION.format(topic=topic, documentation=documentation)
-    code = llama3.invoke(prompt, temperature=0.3)
 
-    code = code[code.index("```"):]
+def _format_code(code: str) -> str:
+    # black is only imported when code is generated, not for saved scripts
+    import black
+
+    try:
+        return black.format_str(code, mode=_black_mode())
+    except black.NothingChanged:
+        return code
+    except black.InvalidInput as e:
+        raise ScriptValidationError(f"The code is not valid Python: {e}") from None
+
+
+def validate_code(code: str):
+    """Raise ScriptValidationError unless the formatted code fits on a slide."""
+    lines = code.splitlines()
+    if not lines:
+        raise ScriptValidationError("The code is empty.")
+    if len(lines) > MAX_CODE_LINES:
+        raise ScriptValidationError(f"The code has {len(lines)} lines, at most {MAX_CODE_LINES} are allowed.")
+
+    long_lines = [f"{idx + 1}: {line}" for idx, line in enumerate(lines) if len(line) > MAX_LINE_LENGTH]
+    if long_lines:
+        raise ScriptValidationError(
+            f"These lines are longer than {MAX_LINE_LENGTH} characters:\n" + "\n".join(long_lines)
+        )
+
+
+T = TypeVar("T")
+
 
-    code = code.strip().strip("`")
-    if code.startswith("python\n"):
-        code = code[7:]
+def _ask_until_valid(step: str, prompt: str, attempt: Callable[[str, bool], T], temperature: float) -> T:
+    """Return attempt(prompt, use_cache), asking again with the validation error while the budget lasts.
+
+    A rejected answer is dropped from the LLM cache, and retries skip it, so
+    neither a retry nor the next run of the job gets the same answer again.
+    """
+    request = prompt
+    for retry in range(LLM_VALIDATION_RETRIES + 1):
+        use_cache = retry == 0
+        try:
+            return attempt(request, use_cache)
+        except ScriptValidationError as e:
+            if use_cache:
+                get_router().forget(step, request, temperature=temperature)
+            if retry == LLM_VALIDATION_RETRIES:
+                raise ScriptValidationError(f"Invalid {step} after {retry + 1} attempts: {e}", e.output) from None
+            logger.warning("Asking for the %s again, attempt %d was rejected: %s", step, retry + 1, e)
+            request = PROMPT_RETRY.format(prompt=prompt, output=e.output, error=e)
+
+
+def _extract_code(output: str) -> str:
+    # the model is asked for bare code but often fences it anyway, sometimes
+    # with prose around it
+    fenced = re.search(r"```(?:python)?\n(.*?)(?:```|$)", output, re.DOTALL)
+    code = fenced.group(1) if fenced else output
 
     # remove all comments
     code = "\n".join([line for line in code.split("\n") if not line.strip().startswith("#")])
 
-    code = code.strip().strip("`")
+    return code.strip().strip("`")
 
-    print(code)
 
-    # Format the code
-    black_mode = black.Mode(line_length=42)
-    try:
-        code = black.format_str(code, mode=black_mode)
-    except black.NothingChanged:
-        pass
+def _generate_code(topic: str, library: str) -> str:
+    logger.info(f"Generating code for topic: {topic}")
+    documentation = _fetch_documentation(library)
+    prompt = PROMPT_CODE_GENERATION.format(topic=topic, documentation=documentation)
 
-    print("Formatted code:")
-    print(code)
+    def attempt(request: str, use_cache: bool) -> str:
+        output = get_router().invoke("code", request, temperature=0.3, use_cache=use_cache)
+        code = _extract_code(output)
+        print(code)
 
-    return code
+        try:
+            # Format the code
+            code = _format_code(code)
+            validate_code(code)
+        except ScriptValidationError as e:
+            e.output = output
+            raise
 
+        print("Formatted code:")
+        print(code)
+        return code
 
-def _generate_highlights(topic: str, description: str, code: str) -> list[ScriptCodeHighlight]:
-    logger.info("Generating highlights for topic: %s", topic)
-    annotated_code = _annote_line_numbers(code)
-    prompt = PROMPT_HIGHLIGHTS_GENERATION.format(topic, description, annotated_code)
-    output = gpt4.invoke(prompt)
+    return _ask_until_valid("code", prompt, attempt, temperature=0.3)
 
-    output = output.strip().strip("`")
-    if output.startswith("csv\n"):
-        output = output[4:]
 
-    if output.startswith("start_line_number"):
-        output = '\n'.join(output.split("\n")[1:])
+def _parse_highlight_row(line: str) -> Optional[ScriptCodeHighlight]:
+    # the code fence may share a line with the first or last row
+    line = line.strip().strip("`")
+    if line in ("", "csv") or line.startswith("start_line_number"):
+        return None
 
-    csv_lines = output.split("\n")
-    data = [line.strip().split("|") for line in csv_lines]
+    row = line.split("|")
+    try:
+        start, end, description = row
+    except ValueError:
+        raise ScriptValidationError(f"Row {line!r} doesn't have exactly 3 columns.") from None
+    try:
+        return ScriptCodeHighlight(
+            text=description.strip('"').strip("'"),
+            line_number=int(start) - 1,
+            line_count=int(end) - int(start) + 1,
+        )
+    except ValueError:
+        raise ScriptValidationError(f"Row {line!r} doesn't start with two line numbers.") from None
 
-    result = []
 
-    for row in data:
-        try:
-            start, end, description = row
-        except ValueError:
-            logger.warning(f"Skipping row: {row}")
-            continue
+def parse_highlights(chunks: Iterable[str], errors: Optional[list[str]] = None) -> Iterator[ScriptCodeHighlight]:
+    """Parse the highlights CSV as it streams in, yielding each row once its line is complete.
+
+    Malformed rows are skipped, their errors are appended to `errors` if given.
+    """
+    def parse(line: str) -> Optional[ScriptCodeHighlight]:
         try:
-            result.append(
-                ScriptCodeHighlight(
-                    text=description.strip('"').strip("'"),
-                    line_number=int(start) - 1,
-                    line_count=int(end) - int(start) + 1,
-                )
-            )
-        except ValueError:
-            logger.warning(f"Can't parse row: {row}")
-            continue
+            return _parse_highlight_row(line)
+        except ScriptValidationError as e:
+            logger.warning("Skipping highlight: %s", e)
+            if errors is not None:
+                errors.append(str(e))
+            return None
+
+    buffer = ""
+    for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split("\n")
+        for line in lines:
+            highlight = parse(line)
+            if highlight is not None:
+                yield highlight
+
+    highlight = parse(buffer)
+    if highlight is not None:
+        yield highlight
+
+
+def validate_highlight(highlight: ScriptCodeHighlight, code_lines: int):
+    """Raise ScriptValidationError unless the highlight covers lines of the code."""
+    first = highlight.line_number + 1
+    last = highlight.line_number + highlight.line_count
+    if highlight.line_count < 1:
+        raise ScriptValidationError(f"Block {first}-{last} ends before it starts.")
+    if first < 1 or last > code_lines:
+        raise ScriptValidationError(f"Block {first}-{last} is outside of the code's lines 1-{code_lines}.")
+    if not highlight.text.strip():
+        raise ScriptValidationError(f"Block {first}-{last} has no description.")
+
+
+def _generate_highlights(
+    topic: str,
+    description: str,
+    code: str,
+    on_highlight: Optional[Callable[[int, ScriptCodeHighlight], None]] = None,
+) -> list[ScriptCodeHighlight]:
+    logger.info("Generating highlights for topic: %s", topic)
+    annotated_code = _annote_line_numbers(code)
+    prompt = PROMPT_HIGHLIGHTS_GENERATION.format(topic, description, annotated_code)
+    code_lines = len(code.splitlines())
+
+    def attempt(request: str, use_cache: bool) -> list[ScriptCodeHighlight]:
+        output = []
+        errors = []
+        result = []
+
+        def chunks():
+            for chunk in get_router().invoke_stream("highlights", request, use_cache=use_cache):
+                output.append(chunk)
+                yield chunk
+
+        for highlight in parse_highlights(chunks(), errors):
+            try:
+                validate_highlight(highlight, code_lines)
+            except ScriptValidationError as e:
+                errors.append(str(e))
+                continue
+            # valid rows are passed on right away, even if a later row fails
+            if on_highlight is not None:
+                on_highlight(len(result), highlight)
+            result.append(highlight)
+
+        if not result:
+            errors.append("There are no highlights.")
+        if errors:
+            raise ScriptValidationError("\n".join(errors), "".join(output))
+        return result
+
+    result = _ask_until_valid("highlights", prompt, attempt, temperature=0.3)
 
     pprint(result)
 
     return result
 
 
-def generate_script(topic: str, library: str) -> Script:
+async def _timed(timings: dict[str, float], step: str, func, *args):
+    # the LLM clients are blocking, run each step in its own thread
+    start = time.perf_counter()
+    with tracing.span(step, "script"):
+        result = await asyncio.to_thread(func, *args)
+    timings[step] = time.perf_counter() - start
+    return result
+
+
+async def generate_script_async(
+    topic: str,
+    library: str,
+    on_narration: Optional[Callable[[int, str], None]] = None,
+) -> Script:
+    """Generate the script of a short.
+
+    `on_narration(idx, text)` is called as soon as the text of the intro
+    (index 0) or of a highlight (index i + 1) is written and valid, before
+    the rest of the script is, so e.g. speech synthesis can start early.
+    Rows of a highlights answer that is rejected later are passed on too,
+    and a retry passes its rows again from index 1.
+    """
     logger.info(f"Generating script for topic: {topic}")
-    description = _generate_topic_description(topic)
-    code = _generate_code(topic, description, library)
+    timings = {}
+    start = time.perf_counter()
+
+    async def describe() -> str:
+        description = await _timed(timings, "description", _generate_topic_description, topic)
+        # the intro can be narrated while the code is still being written
+        if on_narration is not None:
+            on_narration(0, description)
+        return description
+
+    # the description and the code (including the documentation fetch) are
+    # independent, only the highlights need both
+    description, code = await asyncio.gather(
+        describe(),
+        _timed(timings, "code", _generate_code, topic, library),
+    )
 
-    highlights = _generate_highlights(topic, description, code)
+    on_highlight = None
+    if on_narration is not None:
+        def on_highlight(idx: int, highlight: ScriptCodeHighlight):
+            on_narration(idx + 1, highlight.text)
+
+    highlights = await _timed(timings, "highlights", _generate_highlights, topic, description, code, on_highlight)
+    timings["total"] = time.perf_counter() - start
+    logger.info("Script generation timings: %s", timings)
 
     script = Script(
         code=code,
@@ -215,6 +409,34 @@ def generate_script(topic: str, library: str) -> Script:
         intro_text_voide_clip=None,
         highlights=highlights,
         cta_text="",
+        timings=timings,
     )
 
     return script
+
+
+def generate_script(
+    topic: str,
+    library: str,
+    on_narration: Optional[Callable[[int, str], None]] = None,
+) -> Script:
+    return asyncio.run(generate_script_async(topic, library, on_narration))
+
+
+def save_script(script: Script, path: str):
+    data = asdict(script)
+    # audio is produced by a later stage and tracked separately
+    data.pop("intro_text_voide_clip")
+    for highlight in data["highlights"]:
+        highlight.pop("voice_clip")
+
+    with open(path, "w") as f:
+        json.dump(data, f, indent=2)
+
+
+def load_script(path: str) -> Script:
+    with open(path) as f:
+        data = json.load(f)
+
+    data["highlights"] = [ScriptCodeHighlight(**highlight) for highlight in data["highlights"]]
+    return Script(**data)
@@ -0,0 +1,150 @@
+import asyncio
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Optional
+
+try:
+    import resource
+except ImportError:
+    # Windows, where the CPU time of subprocesses isn't recorded
+    resource = None
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Span:
+    name: str
+    category: str
+    start: float
+    duration: float = 0.0
+    # CPU time of subprocesses that exited during the span. Children of
+    # concurrent spans (e.g. parallel batch jobs) are counted in each of them,
+    # unless the span sets it itself, like the ffmpeg runner's spans do.
+    subprocess_cpu: Optional[float] = None
+    bytes: int = 0
+    pid: int = 0
+    track: int = 0
+    args: dict = field(default_factory=dict)
+
+
+def _track() -> int:
+    # concurrent asyncio tasks share a thread, give each its own track
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    return id(task) if task is not None else threading.get_ident()
+
+
+def _children_cpu() -> float:
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class Tracer:
+    """Collects the spans of one job.
+
+    Spans are recorded with wall clock timestamps so spans collected in
+    render worker processes can be merged in with `extend`.
+    """
+
+    def __init__(self):
+        self.spans: list[Span] = []
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name: str, category: str, **args):
+        span = Span(name=name, category=category, start=time.time(), pid=os.getpid(), track=_track(), args=args)
+        start = time.perf_counter()
+        children_cpu = _children_cpu()
+        try:
+            yield span
+        finally:
+            span.duration = time.perf_counter() - start
+            if span.subprocess_cpu is None:
+                span.subprocess_cpu = _children_cpu() - children_cpu
+            with self._lock:
+                self.spans.append(span)
+
+    def extend(self, spans: list[Span]):
+        with self._lock:
+            self.spans.extend(spans)
+
+    def summary(self) -> dict[str, dict]:
+        """Totals per category; nested spans of the same category are counted twice."""
+        totals = {}
+        for span in self.spans:
+            total = totals.setdefault(span.category, {"count": 0, "seconds": 0.0, "subprocess_cpu": 0.0, "bytes": 0})
+            total["count"] += 1
+            total["seconds"] += span.duration
+            total["subprocess_cpu"] += span.subprocess_cpu
+            total["bytes"] += span.bytes
+        return totals
+
+    def write_report(self, path: str):
+        with open(path, "w") as f:
+            json.dump({
+                "summary": self.summary(),
+                "spans": [asdict(span) for span in sorted(self.spans, key=lambda span: span.start)],
+            }, f, indent=2)
+
+    def write_chrome_trace(self, path: str):
+        """Write the spans in the Trace Event Format of chrome://tracing and Perfetto."""
+        events = [
+            {
+                "name": span.name,
+                "cat": span.category,
+                "ph": "X",
+                "ts": span.start * 1e6,
+                "dur": span.duration * 1e6,
+                "pid": span.pid,
+                "tid": span.track,
+                "args": {**span.args, "bytes": span.bytes, "subprocess_cpu": span.subprocess_cpu},
+            }
+            for span in self.spans
+        ]
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events}, f)
+
+    def write(self, work_dir: str):
+        self.write_report(os.path.join(work_dir, "trace.json"))
+        self.write_chrome_trace(os.path.join(work_dir, "trace.chrome.json"))
+        logger.info("Trace summary: %s", self.summary())
+
+
+_current: contextvars.ContextVar[Optional[Tracer]] = contextvars.ContextVar("tracer", default=None)
+
+
+@contextlib.contextmanager
+def use(tracer: Tracer):
+    """Record the spans of the current thread (and tasks and threads it starts with a copy of its context) in tracer."""
+    token = _current.set(tracer)
+    try:
+        yield tracer
+    finally:
+        _current.reset(token)
+
+
+def current() -> Optional[Tracer]:
+    return _current.get()
+
+
+@contextlib.contextmanager
+def span(name: str, category: str, **args):
+    """Record a span in the current tracer; without one the span is still yielded but dropped."""
+    tracer = _current.get()
+    if tracer is None:
+        yield Span(name=name, category=category, start=time.time())
+        return
+    with tracer.span(name, category, **args) as recorded:
+        yield recorded
@@ -0,0 +1,82 @@
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from typing import Optional
+
+
+logger = logging.getLogger(__name__)
+
+TTS_CACHE_DIR = os.getenv("TTS_CACHE_DIR", "./assets/cache/tts")
+# Least recently used entries are evicted once the cache grows past this size.
+TTS_CACHE_MAX_BYTES = int(os.getenv("TTS_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+
+
+def cache_key(text: str, **settings) -> str:
+    """Content address of a synthesized clip: the text plus everything that changes the audio."""
+    payload = json.dumps({"text": text, **settings}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _entry_paths(key: str) -> tuple[str, str]:
+    return (
+        os.path.join(TTS_CACHE_DIR, f"{key}.mp3"),
+        os.path.join(TTS_CACHE_DIR, f"{key}.json"),
+    )
+
+
+def get(key: str, save_as: str) -> Optional[float]:
+    """Copy a cached clip to save_as and return its duration, or None on a miss."""
+    audio_path, meta_path = _entry_paths(key)
+    try:
+        with open(meta_path) as f:
+            duration = json.load(f)["duration"]
+        shutil.copyfile(audio_path, save_as)
+    except (OSError, ValueError, KeyError):
+        return None
+
+    # mtime doubles as the last access time for LRU eviction
+    os.utime(audio_path)
+    logger.info("TTS cache hit for %s", save_as)
+    return duration
+
+
+def put(key: str, file_path: str, duration: float):
+    os.makedirs(TTS_CACHE_DIR, exist_ok=True)
+    audio_path, meta_path = _entry_paths(key)
+
+    # write to a temporary file first so concurrent readers never see a partial clip
+    fd, tmp_path = tempfile.mkstemp(dir=TTS_CACHE_DIR, suffix=".tmp")
+    os.close(fd)
+    shutil.copyfile(file_path, tmp_path)
+    os.replace(tmp_path, audio_path)
+
+    with open(meta_path, "w") as f:
+        json.dump({"duration": duration}, f)
+
+    evict(TTS_CACHE_MAX_BYTES)
+
+
+def evict(max_bytes: int):
+    entries = []
+    for name in os.listdir(TTS_CACHE_DIR):
+        if not name.endswith(".mp3"):
+            continue
+        path = os.path.join(TTS_CACHE_DIR, name)
+        # another process may be evicting at the same time
+        with contextlib.suppress(FileNotFoundError):
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        logger.info("Evicting %s from TTS cache", path)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+            os.remove(path[:-len(".mp3")] + ".json")
+        total -= size
@@ -7,19 +7,30 @@
 
 from dataclasses import dataclass
 import datetime
+import hashlib
 from http import client
 import httplib2
+import json
+import logging
 import os
 import random
+import threading
 import time
+from typing import Optional
+import urllib.parse
 
-import google.oauth2.credentials
-import google_auth_oauthlib.flow
+from google.auth.exceptions import RefreshError
+from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 from googleapiclient.http import MediaFileUpload
 from google_auth_oauthlib.flow import InstalledAppFlow
 
+from src import tracing
+
+
+logger = logging.getLogger(__name__)
 
 # Explicitly tell the underlying HTTP transport library not to retry, since
 # we are handling retry logic ourselves.
@@ -38,6 +49,9 @@ RETRIABLE_EXCEPTIONS = (httplib2.HttpLib2Error, IOError, client.NotConnected,
 # codes is raised.
 RETRIABLE_STATUS_CODES = [500, 502, 503, 504]
 
+# The upload session of a resumed upload expired, start a new one.
+EXPIRED_SESSION_STATUS_CODES = [404, 410]
+
 # The CLIENT_SECRETS_FILE variable specifies the name of a file that contains
 # the OAuth 2.0 information for this application, including its client_id and
 # client_secret. You can acquire an OAuth 2.0 client ID and client secret from
@@ -50,6 +64,18 @@ RETRIABLE_STATUS_CODES = [500, 502, 503, 504]
 #   https://developers.google.com/api-client-library/python/guide/aaa_client_secrets
 CLIENT_SECRETS_FILE = './client_secret.json'
 
+# Authorized credentials, including the refresh token, are kept here so the
+# browser consent flow only runs once.
+YOUTUBE_TOKEN_FILE = os.getenv("YOUTUBE_TOKEN_FILE", "./assets/cache/youtube_token.json")
+# Upload session URIs of unfinished uploads, so a crashed upload resumes
+# from the last byte the server acknowledged.
+YOUTUBE_UPLOAD_SESSIONS_DIR = os.getenv("YOUTUBE_UPLOAD_SESSIONS_DIR", "./assets/cache/uploads")
+# Bytes sent per request; must be a multiple of 256 KiB. Smaller chunks lose
+# less progress on a flaky connection, larger ones need fewer round trips.
+YOUTUBE_UPLOAD_CHUNKSIZE = int(os.getenv("YOUTUBE_UPLOAD_CHUNKSIZE", 8 * 1024 * 1024))
+# Overrides the upload host, e.g. to point at a local fake upload server.
+YOUTUBE_API_ENDPOINT = os.getenv("YOUTUBE_API_ENDPOINT")
+
 # This OAuth 2.0 access scope allows an application to upload files to the
 # authenticated user's YouTube channel, but doesn't allow other types of access.
 SCOPES = ['https://www.googleapis.com/auth/youtube.upload']
@@ -58,6 +84,14 @@ API_VERSION = 'v3'
 
 VALID_PRIVACY_STATUSES = ('public', 'private', 'unlisted')
 
+# Shared by every upload thread, see get_credentials.
+_credentials: Optional[Credentials] = None
+_credentials_lock = threading.Lock()
+
+
+class UploadError(Exception):
+    pass
+
 
 @dataclass
 class UploadOptions:
@@ -69,15 +103,94 @@ class UploadOptions:
     privacyStatus: str
 
 
+def _save_credentials(credentials: Credentials):
+    os.makedirs(os.path.dirname(YOUTUBE_TOKEN_FILE) or ".", exist_ok=True)
+    tmp_path = YOUTUBE_TOKEN_FILE + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(credentials.to_json())
+    os.replace(tmp_path, YOUTUBE_TOKEN_FILE)
+
+
+def get_credentials() -> Credentials:
+    """Return cached credentials, refreshing them or asking for consent only when needed."""
+    global _credentials
+    with _credentials_lock:
+        if _credentials is None and os.path.exists(YOUTUBE_TOKEN_FILE):
+            _credentials = Credentials.from_authorized_user_file(YOUTUBE_TOKEN_FILE, SCOPES)
+
+        if _credentials is not None and _credentials.valid:
+            return _credentials
+
+        if _credentials is not None and _credentials.expired and _credentials.refresh_token:
+            try:
+                _credentials.refresh(Request())
+            except RefreshError as e:
+                logger.warning("Refreshing YouTube credentials failed, authorizing again: %s", e)
+                _credentials = None
+        else:
+            _credentials = None
+
+        if _credentials is None:
+            flow = InstalledAppFlow.from_client_secrets_file(CLIENT_SECRETS_FILE, SCOPES)
+            _credentials = flow.run_local_server()
+
+        _save_credentials(_credentials)
+        return _credentials
+
+
 # Authorize the request and store authorization credentials.
 def get_authenticated_service():
-    flow = InstalledAppFlow.from_client_secrets_file(
-        CLIENT_SECRETS_FILE, SCOPES)
-    credentials = flow.run_local_server()
-    return build(API_SERVICE_NAME, API_VERSION, credentials=credentials)
+    # httplib2 connections are not thread safe, so every upload builds its own
+    # service around the shared credentials
+    return build(API_SERVICE_NAME, API_VERSION, credentials=get_credentials(), static_discovery=True)
+
+
+def _with_endpoint(uri: str) -> str:
+    if not YOUTUBE_API_ENDPOINT:
+        return uri
+    endpoint = urllib.parse.urlsplit(YOUTUBE_API_ENDPOINT)
+    return urllib.parse.urlsplit(uri)._replace(scheme=endpoint.scheme, netloc=endpoint.netloc).geturl()
 
 
-def upload_to_youtube(options: UploadOptions):
+def _session_path(file_path: str) -> str:
+    key = hashlib.sha256(os.path.abspath(file_path).encode("utf-8")).hexdigest()
+    return os.path.join(YOUTUBE_UPLOAD_SESSIONS_DIR, f"{key}.json")
+
+
+def _file_signature(file_path: str) -> list:
+    stat = os.stat(file_path)
+    return [stat.st_size, stat.st_mtime]
+
+
+def _load_session(file_path: str) -> Optional[str]:
+    try:
+        with open(_session_path(file_path)) as f:
+            session = json.load(f)
+    except (OSError, ValueError):
+        return None
+    # a re-rendered video must not be appended to the old one's upload
+    if session["signature"] != _file_signature(file_path):
+        return None
+    return session["resumable_uri"]
+
+
+def _save_session(file_path: str, resumable_uri: str):
+    os.makedirs(YOUTUBE_UPLOAD_SESSIONS_DIR, exist_ok=True)
+    tmp_path = _session_path(file_path) + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"signature": _file_signature(file_path), "resumable_uri": resumable_uri}, f)
+    os.replace(tmp_path, _session_path(file_path))
+
+
+def _clear_session(file_path: str):
+    try:
+        os.remove(_session_path(file_path))
+    except FileNotFoundError:
+        pass
+
+
+def upload_to_youtube(options: UploadOptions, chunksize: int = YOUTUBE_UPLOAD_CHUNKSIZE) -> str:
+    """Upload a video and return its id, resuming an earlier interrupted upload of the same file."""
     youtube = get_authenticated_service()
 
     tags = None
@@ -108,57 +221,72 @@ def upload_to_youtube(options: UploadOptions):
         # bytes, that will be uploaded at a time. Set a higher value for
         # reliable connections as fewer chunks lead to faster uploads. Set a lower
         # value for better recovery on less reliable connections.
-        #
-        # Setting 'chunksize' equal to -1 in the code below means that the entire
-        # file will be uploaded in a single HTTP request. (If the upload fails,
-        # it will still be retried where it left off.) This is usually a best
-        # practice, but if you're using Python older than 2.6 or if you're
-        # running on App Engine, you should set the chunksize to something like
-        # 1024 * 1024 (1 megabyte).
-        media_body=MediaFileUpload(options.file, chunksize=-1, resumable=True)
+        media_body=MediaFileUpload(options.file, chunksize=chunksize, resumable=True)
     )
+    insert_request.uri = _with_endpoint(insert_request.uri)
 
-    try:
-        resumable_upload(insert_request)
-        return True
-    except HttpError as e:
-        print('An HTTP error %d occurred:\n%s' % (e.resp.status, e.content))
-        return False
+    resumable_uri = _load_session(options.file)
+    if resumable_uri is not None:
+        logger.info("Resuming upload of %s", options.file)
+        insert_request.resumable_uri = resumable_uri
+        # makes next_chunk ask the server how many bytes it already has
+        insert_request._in_error_state = True
+
+    with tracing.span(os.path.basename(options.file), "upload", resumed=resumable_uri is not None) as span:
+        response = resumable_upload(insert_request, options.file)
+        span.bytes = os.path.getsize(options.file)
+    _clear_session(options.file)
+    return response['id']
 
 # This method implements an exponential backoff strategy to resume a
 # failed upload.
 
 
-def resumable_upload(request):
+def resumable_upload(request, file_path: str) -> dict:
     response = None
-    error = None
     retry = 0
+    saved_uri = request.resumable_uri
     while response is None:
+        error = None
         try:
-            print('Uploading file...')
             status, response = request.next_chunk()
-            if response is not None:
-                if 'id' in response:
-                    print('Video id "%s" was successfully uploaded.' %
-                          response['id'])
-                else:
-                    exit('The upload failed with an unexpected response: %s' % response)
-        except (HttpError, e):
+            if status is not None:
+                logger.info("Uploaded %d%% of %s", int(status.progress() * 100), file_path)
+        except HttpError as e:
             if e.resp.status in RETRIABLE_STATUS_CODES:
                 error = 'A retriable HTTP error %d occurred:\n%s' % (e.resp.status,
-                                                                     e.content)
+                                                                    e.content)
+            elif e.resp.status in EXPIRED_SESSION_STATUS_CODES and request.resumable_uri is not None:
+                logger.warning("Upload session of %s expired, starting over", file_path)
+                _clear_session(file_path)
+                request.resumable_uri = None
+                request.resumable_progress = 0
+                request._in_error_state = False
+                saved_uri = None
+                continue
             else:
                 raise
-        except (RETRIABLE_EXCEPTIONS, e):
+        except RETRIABLE_EXCEPTIONS as e:
             error = 'A retriable error occurred: %s' % e
 
+        # persisted as soon as the server assigns it
+        if response is None and request.resumable_uri not in (None, saved_uri):
+            _save_session(file_path, request.resumable_uri)
+            saved_uri = request.resumable_uri
+
         if error is not None:
-            print(error)
+            logger.warning(error)
             retry += 1
             if retry > MAX_RETRIES:
-                exit('No longer attempting to retry.')
+                raise UploadError(f"Giving up uploading {file_path} after {MAX_RETRIES} retries")
 
             max_sleep = 2 ** retry
             sleep_seconds = random.random() * max_sleep
-            print('Sleeping %f seconds and then retrying...' % sleep_seconds)
+            logger.info('Sleeping %f seconds and then retrying...', sleep_seconds)
             time.sleep(sleep_seconds)
+
+    if 'id' not in response:
+        raise UploadError('The upload failed with an unexpected response: %s' % response)
+
+    logger.info('Video id "%s" was successfully uploaded.', response['id'])
+    return response
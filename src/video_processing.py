@@ -1,131 +1,230 @@
-from dataclasses import dataclass
-import io
+import concurrent.futures
+from dataclasses import asdict, dataclass, replace
+import functools
 import logging
-import subprocess
+import os
+from typing import Optional
 
-import pixie
-import black
+import numpy as np
 import PIL.Image
-from pygments import highlight
-from pygments.style import Style
-from pygments.lexers import PythonLexer
-from pygments.formatters import ImageFormatter
-from pygments.token import (
-    Keyword,
-    Name,
-    Comment,
-    String,
-    Error,
-    Number,
-    Operator,
-    Generic,
-    Punctuation,
-)
+import PIL.ImageDraw
 
+from src import ffmpeg_runner, tracing
+from src.animation import AnimatedCompositor, Segment
+from src.code_image import CodeImage, render_code
 from src.script_processing import Script
-from src.audio_processing import combine_audio_clips
+from src.audio_processing import VoiceClip, audio_input_args, voice_clip_key
+from src.build_graph import BuildGraph
 
 
 logger = logging.getLogger(__name__)
 
-
-class SimpleStyle(Style):
-    default_style = ""
-    background_color = "#212121"
-    styles = {
-        Comment: "italic #888",
-        Keyword: "#2e95d3",
-        Name: "#fff",
-        Name.Function: "#e9950c",
-        Name.Class: "bold #0f0",
-        String: "#ba2121",
-        Error: "bg:#F00 #FFF",
-        Number: "#df3079",
-        Operator: "#fff",
-        Punctuation: "#fff",
-        Generic.Output: "#888",
-    }
-
-
-def generate_code_image(code: str):
+# "single_pass" encodes every frame and muxes the narration in one ffmpeg
+# process, "clips" encodes one clip per frame and concatenates them,
+# "animated" renders a smoothly animated video at ANIMATION_FPS,
+# "streaming" renders clips like "clips" while the narration is still being
+# synthesized (see StreamingClipRenderer).
+RENDER_MODE = os.getenv("RENDER_MODE", "single_pass")
+# Number of worker processes rendering frames (and clips) in parallel.
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", os.cpu_count() or 1))
+ANIMATION_FPS = int(os.getenv("ANIMATION_FPS", 30))
+# Output frame rate of the still image modes.
+STILL_FPS = 25
+
+# Space between the highlighted lines and the edges of the highlight box.
+HIGHLIGHT_PAD = 6
+
+
+@dataclass(frozen=True)
+class EncodingProfile:
+    """x264 settings for our content: still images that change every few seconds."""
+    preset: str
+    crf: int
+    tune: Optional[str] = "stillimage"
+    # frames between keyframes; long GOPs cost next to nothing on still images
+    keyint: int = 250
+    # output frame rate, None keeps the render mode's own (STILL_FPS or ANIMATION_FPS)
+    fps: Optional[int] = None
+    # threads per ffmpeg process, 0 lets x264 decide
+    threads: int = 0
+
+    def x264_args(self) -> list[str]:
+        args = [
+            "-c:v", "libx264",
+            "-preset", self.preset,
+            "-crf", str(self.crf),
+            "-g", str(self.keyint),
+            "-threads", str(self.threads),
+        ]
+        if self.tune:
+            args += ["-tune", self.tune]
+        return args + ["-pix_fmt", "yuv420p"]
+
+
+ENCODING_PROFILES = {
+    # quick previews for editorial review
+    "draft": EncodingProfile(preset="ultrafast", crf=32, fps=10),
+    "final": EncodingProfile(preset="medium", crf=20),
+}
+ENCODING_PROFILE = os.getenv("ENCODING_PROFILE", "final")
+
+
+def get_encoding_profile(name: str) -> EncodingProfile:
+    try:
+        return ENCODING_PROFILES[name]
+    except KeyError:
+        raise ValueError(f"Unknown encoding profile: {name}") from None
+
+
+def generate_code_image(code: str) -> CodeImage:
     logger.info("Generating code image")
 
-    # Highlight the code
-    highlighted_code = highlight(
-        code,
-        PythonLexer(),
-        ImageFormatter(
-            style=SimpleStyle,
-            font_name="Courier",
-            line_numbers=False,
-            dpi=400,
-            font_size=40,
-        ),
-    )
-
-    image = PIL.Image.open(io.BytesIO(highlighted_code))
-    path = "./assets/images/code_image.png"
-    image.save(path)
-
-    return path
+    # the glyphs are rasterized once per process and copied into place, the
+    # image stays in memory and frames are piped to ffmpeg without touching
+    # the disk
+    return render_code(code)
+
+
+class FrameCompositor:
+    """Renders the frames of one code image.
+
+    The background and the code image never change between frames, so they
+    are composited once into a base layer. Each frame is a copy of that base
+    with only the highlight box and the progress bar drawn on top.
+    """
+
+    def __init__(self, code_image: CodeImage, frame_w=1080, frame_h=1920):
+        self.code_image = code_image
+        self.frame_w = frame_w
+        self.frame_h = frame_h
+        self.code_image_x = (frame_w - code_image.width) // 2
+        self.code_image_y = (frame_h - code_image.height) // 2
+
+        self.base = PIL.Image.new("RGB", (frame_w, frame_h), (31, 31, 31))
+        self.base.paste(code_image.to_image(), (self.code_image_x, self.code_image_y))
+
+    def highlight_box(self, highlighted_code_block) -> Optional[tuple[int, int]]:
+        """Top and bottom of the highlight box of a code block in the frame, None for no box."""
+        span = self.code_image.line_span(highlighted_code_block.line_number, highlighted_code_block.line_count)
+        if span is None:
+            return None
+        return self.code_image_y + span[0] - HIGHLIGHT_PAD, self.code_image_y + span[1] + HIGHLIGHT_PAD
+
+    def render(self, highlighted_code_block, frame_idx: int = 0, frames_number: int = 1) -> PIL.Image.Image:
+        image = self.base.copy()
+        # drawing in RGBA mode blends the translucent fills into the frame
+        draw = PIL.ImageDraw.Draw(image, "RGBA")
+
+        box = self.highlight_box(highlighted_code_block)
+        if box is not None:
+            draw.rounded_rectangle(
+                (
+                    self.code_image_x,
+                    box[0],
+                    self.code_image_x + self.code_image.width,
+                    box[1],
+                ),
+                radius=25,
+                fill=(255, 0, 0, 26),
+            )
+
+        progress_width = self.code_image.width * (frame_idx / frames_number)
+        if progress_width > 0:
+            draw.rectangle(
+                (0, 0, progress_width - 1, self.frame_h * 0.05),
+                fill=(130, 56, 235, 77),
+            )
+
+        return image
 
 
 def generate_frame(
-    code_image,
+    code_image: CodeImage,
     highlighted_code_block,
     frame_w=1080,
     frame_h=1920,
     frame_idx: int = 0,
     frames_number: int = 1,
-):
-    image = pixie.Image(frame_w, frame_h)
-    image.fill(pixie.Color(0.12, 0.12, 0.12, 1))
+) -> PIL.Image.Image:
+    compositor = FrameCompositor(code_image, frame_w, frame_h)
+    return compositor.render(highlighted_code_block, frame_idx, frames_number)
+
+
+class FrameStreamEncoder:
+    """Encodes raw RGB frames piped to ffmpeg's stdin.
+
+    With durations, frame i is shown for durations[i] seconds, so each
+    distinct still is sent only once instead of once per output frame.
+    Without, every frame written is one output frame at `fps`. Optionally
+    muxes the voice clips, each taking up exactly its duration.
+    """
+
+    def __init__(
+        self,
+        output_path: str,
+        durations: Optional[list[float]] = None,
+        frame_w: int = 1080,
+        frame_h: int = 1920,
+        voice_clips: Optional[list[VoiceClip]] = None,
+        fps: int = STILL_FPS,
+        profile: EncodingProfile = ENCODING_PROFILES["final"],
+    ):
+        self.output_path = output_path
+        self.durations = durations
+        self.frames_written = 0
+        self.last_frame = None
+
+        input_rate = fps if durations is None else 1
+        command = [
+            "-y",
+            "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", f"{frame_w}x{frame_h}", "-r", str(input_rate), "-i", "-",
+        ]
+        if voice_clips is not None:
+            command += audio_input_args(voice_clips, first_input=1)
+
+        if durations is not None:
+            # setpts places every frame at the start of its segment; the last
+            # frame is sent twice, stamped at the end, so fps holds it until then
+            starts = [sum(durations[:idx]) for idx in range(len(durations) + 1)]
+            # a flat sum, ffmpeg's parser rejects if() nested about 100 deep
+            pts_expr = "+".join(f"eq(N,{idx})*{starts[idx]}" for idx in range(1, len(starts))) or "0"
+            command += [
+                # quoted, the commas in the expression would otherwise split the filter chain
+                "-vf", f"settb=AVTB,setpts='({pts_expr})/TB',fps={fps}",
+                "-t", str(starts[-1]),
+            ]
+
+        command += ["-map", "0:v"] + profile.x264_args()
+        if voice_clips is not None:
+            command += ["-map", "[audio]", "-c:a", "aac"]
+        command.append(output_path)
+
+        self.process = ffmpeg_runner.FFmpegProcess(
+            command, f"encode {os.path.basename(output_path)}", stdin=True, output_path=output_path,
+        )
 
-    code_image_x = (frame_w - code_image.width) // 2
-    code_image_y = (frame_h - code_image.height) // 2
+    def write(self, frame: bytes):
+        self.process.write(frame)
+        self.last_frame = frame
+        self.frames_written += 1
 
-    image.draw(
-        code_image,
-        pixie.translate(
-            code_image_x,
-            code_image_y,
-        ),
-    )
+    def close(self):
+        if self.durations is not None:
+            if self.frames_written != len(self.durations):
+                self.process.cancel()
+                raise ValueError(f"Expected {len(self.durations)} frames, got {self.frames_written}")
+            self.process.write(self.last_frame)
 
-    paint = pixie.Paint(pixie.SOLID_PAINT)
-    paint.color = pixie.Color(1, 0, 0, 0.1)
-
-    line_height = 371 / 11
-
-    if highlighted_code_block.line_count > 0:
-        ctx = image.new_context()
-        ctx.fill_style = paint
-        ctx.rounded_rect(
-            code_image_x + 0,
-            code_image_y + line_height * highlighted_code_block.line_number,
-            code_image.width,
-            line_height * highlighted_code_block.line_count + 14,
-            25,
-            25,
-            25,
-            25,
-        )
-        ctx.fill()
-
-    progress_paint = pixie.Paint(pixie.SOLID_PAINT)
-    progress_paint.color = pixie.Color(0.51, 0.22, 0.92, 0.3)
-    
-    ctx = image.new_context()
-    ctx.fill_style = progress_paint
-    ctx.rect(
-        0,
-        0,
-        code_image.width * (frame_idx / frames_number),
-        frame_h * 0.05,
-    )
-    ctx.fill()
+        self.process.wait()
+
+    def __enter__(self):
+        return self
 
-    return image
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.process.cancel()
 
 
 @dataclass
@@ -134,78 +233,386 @@ class HighlightedCodeBlock:
     line_count: int
 
 
-def add_audio_to_video(video_path: str, voice_path: str, start_offset: int):
-    new_path = f"./assets/clips/final.mp4"
-    command = f"ffmpeg -i {video_path} -itsoffset {start_offset} -i {voice_path} -map 0:v -map 1:a -c:v copy -c:a aac -y {new_path}  -hide_banner -loglevel error"
-    subprocess.run(command, shell=True, check=True, capture_output=False)
-    
+def add_audio_to_video(video_path: str, voice_clips: list[VoiceClip], work_dir: str = "./assets"):
+    new_path = os.path.join(work_dir, "clips", "final.mp4")
+    command = (
+        ["-y", "-i", video_path]
+        + audio_input_args(voice_clips, first_input=1)
+        + ["-map", "0:v", "-map", "[audio]", "-c:v", "copy", "-c:a", "aac", new_path]
+    )
+    ffmpeg_runner.run(command, "mux audio", output_path=new_path)
+
     return new_path
 
 
-def generate_video(script: Script):
-    code_image_path = generate_code_image(script.code)
-    code_image = pixie.read_image(code_image_path)
+@dataclass
+class FrameSpec:
+    name: str
+    code_block: HighlightedCodeBlock
+    frame_idx: int
+    duration: float
+
+    @property
+    def clip_name(self) -> str:
+        return f"clip_{self.name}.mp4"
 
-    frames_number = len(script.highlights) + 1
 
-    frame = generate_frame(
-        code_image=code_image,
-        highlighted_code_block=HighlightedCodeBlock(
-            line_number=-1,
-            line_count=0,
+def _voice_clips(script: Script) -> list[VoiceClip]:
+    return [script.intro_text_voide_clip] + [code_block.voice_clip for code_block in script.highlights]
+
+
+def _frame_spec(script: Script, frame_idx: int, duration: float) -> FrameSpec:
+    """Frame 0 is the intro, frame i + 1 shows highlight i."""
+    if frame_idx == 0:
+        return FrameSpec(
+            name="intro",
+            code_block=HighlightedCodeBlock(line_number=-1, line_count=0),
+            frame_idx=0,
+            duration=duration,
+        )
+
+    code_block = script.highlights[frame_idx - 1]
+    return FrameSpec(
+        name=str(frame_idx - 1),
+        code_block=HighlightedCodeBlock(
+            line_number=code_block.line_number,
+            line_count=code_block.line_count,
         ),
-        frame_idx=0,
-        frames_number=frames_number,
+        frame_idx=frame_idx,
+        duration=duration,
     )
-    frame.write_file("./assets/images/frame_intro.png")
-    dur = script.intro_text_voide_clip.duration
-    command = f"ffmpeg -y -loop 1 -i ./assets/images/frame_intro.png -c:v libx264 -t {dur} -pix_fmt yuv420p ./assets/clips/clip_intro.mp4  -hide_banner -loglevel error"
-    subprocess.run(command, shell=True, check=True, capture_output=False)
-
-    for idx, code_block in enumerate(script.highlights):
-        logger.info("Generating frame %d", idx)
-        frame = generate_frame(
-            code_image=code_image,
-            highlighted_code_block=HighlightedCodeBlock(
-                line_number=code_block.line_number,
-                line_count=code_block.line_count,
-            ),
-            frame_idx=idx + 1,
+
+
+def _frame_specs(script: Script) -> list[FrameSpec]:
+    return [
+        _frame_spec(script, frame_idx, voice_clip.duration)
+        for frame_idx, voice_clip in enumerate(_voice_clips(script))
+    ]
+
+
+def _render_frame(compositor: FrameCompositor, spec: FrameSpec, frames_number: int) -> bytes:
+    logger.info("Generating frame %s", spec.name)
+    with tracing.span(f"frame {spec.name}", "render") as span:
+        frame = compositor.render(
+            highlighted_code_block=spec.code_block,
+            frame_idx=spec.frame_idx,
             frames_number=frames_number,
-        )
-        frame.write_file(f"./assets/images/frame_{idx}.png")
+        ).tobytes()
+        span.bytes = len(frame)
+    return frame
 
-        dur = code_block.voice_clip.duration
-        command = f"ffmpeg -y -loop 1 -i ./assets/images/frame_{idx}.png -c:v libx264 -t {dur} -pix_fmt yuv420p ./assets/clips/clip_{idx}.mp4  -hide_banner -loglevel error"
-        subprocess.run(command, shell=True, check=True, capture_output=False)
 
+def _render_clip(
+    compositor: FrameCompositor,
+    spec: FrameSpec,
+    frames_number: int,
+    work_dir: str,
+    profile: EncodingProfile,
+):
+    frame = _render_frame(compositor, spec, frames_number)
+    clip_path = os.path.join(work_dir, "clips", spec.clip_name)
+    with FrameStreamEncoder(
+        clip_path,
+        [spec.duration],
+        compositor.frame_w,
+        compositor.frame_h,
+        fps=profile.fps or STILL_FPS,
+        profile=profile,
+    ) as encoder:
+        encoder.write(frame)
+
+
+# Compositor of a render worker process, set up once by _init_render_worker.
+_worker_compositor: Optional[FrameCompositor] = None
+
+
+def _init_render_worker(code_image: CodeImage):
+    global _worker_compositor
+    _worker_compositor = FrameCompositor(code_image)
+
+
+def _worker_render(func, *args):
+    # the spans are recorded here and handed back to the job's tracer
+    tracer = tracing.Tracer()
+    with tracing.use(tracer):
+        result = func(_worker_compositor, *args)
+    return result, tracer.spans
+
+
+def _collect(worker_result):
+    result, spans = worker_result
+    tracer = tracing.current()
+    if tracer is not None:
+        tracer.extend(spans)
+    return result
+
+
+def _map_frames(func, script: Script, specs: list[FrameSpec], frames_number: int, workers: int, *args):
+    """Yield func(compositor, spec, frames_number, *args) for every spec, in order."""
+    code_image = generate_code_image(script.code)
+
+    if workers <= 1:
+        compositor = FrameCompositor(code_image)
+        for spec in specs:
+            yield func(compositor, spec, frames_number, *args)
+        return
+
+    # every worker process composites the base layer once at start-up
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_render_worker,
+        initargs=(code_image,),
+    ) as executor:
+        for worker_result in executor.map(
+            functools.partial(_worker_render, func),
+            specs,
+            [frames_number] * len(specs),
+            *[[arg] * len(specs) for arg in args],
+        ):
+            yield _collect(worker_result)
+
+
+def _render_single_pass(
+    script: Script,
+    specs: list[FrameSpec],
+    workers: int,
+    work_dir: str,
+    profile: EncodingProfile,
+) -> str:
+    # One ffmpeg process encodes every frame, holding each for its narration
+    # duration, and muxes the audio.
+    video_path = os.path.join(work_dir, "clips", "final.mp4")
+    with FrameStreamEncoder(
+        video_path,
+        [spec.duration for spec in specs],
+        voice_clips=_voice_clips(script),
+        fps=profile.fps or STILL_FPS,
+        profile=profile,
+    ) as encoder:
+        for frame in _map_frames(_render_frame, script, specs, len(specs), workers):
+            encoder.write(frame)
+
+    return video_path
+
+
+def _clip_inputs(script: Script, spec: FrameSpec, frames_number: int, profile: EncodingProfile):
+    return [script.code, asdict(spec), frames_number, asdict(profile)]
+
+
+def _snap_to_frames(spec: FrameSpec, fps: int) -> FrameSpec:
+    # every clip is a whole number of frames long, the narration is padded or
+    # trimmed to the same length so rounding never adds up to drift
+    return replace(spec, duration=max(round(spec.duration * fps), 1) / fps)
+
+
+def _join_clips(script: Script, specs: list[FrameSpec], work_dir: str) -> str:
     # create a text file with the list of videos to concatenate
-    concat_file = "./assets/clips/concat.txt"
+    concat_file = os.path.join(work_dir, "clips", "concat.txt")
     with open(concat_file, "w") as f:
-        f.write("file 'clip_intro.mp4'\n")
-        for idx, code_block in enumerate(script.highlights):
-            f.write(f"file 'clip_{idx}.mp4'\n")
+        for spec in specs:
+            f.write(f"file '{spec.clip_name}'\n")
 
     # combine all the clips into one video
-    video_path = "./assets/clips/combined.mp4"
-    
-    command = (
-        f"ffmpeg -y -f concat -safe 0 -i {concat_file} -c copy {video_path}  -hide_banner -loglevel error"
+    video_path = os.path.join(work_dir, "clips", "combined.mp4")
+    ffmpeg_runner.run(
+        ["-y", "-f", "concat", "-safe", "0", "-i", concat_file, "-c", "copy", video_path],
+        "concat clips",
+        output_path=video_path,
     )
-    subprocess.run(command, shell=True, check=True, capture_output=False)
-    
-    # combine all the audio files into one
-    final_audio_filepath = combine_audio_clips([
-        script.intro_text_voide_clip, 
-    ] + [
-        code_block.voice_clip
-        for code_block in script.highlights
-    ])
-    
-    video_path = add_audio_to_video(
+
+    return add_audio_to_video(
         video_path=video_path,
-        voice_path=final_audio_filepath,
-        start_offset=0,
+        voice_clips=[
+            replace(voice_clip, duration=spec.duration)
+            for voice_clip, spec in zip(_voice_clips(script), specs)
+        ],
+        work_dir=work_dir,
+    )
+
+
+def _render_clips(
+    script: Script,
+    specs: list[FrameSpec],
+    workers: int,
+    work_dir: str,
+    graph: Optional[BuildGraph],
+    profile: EncodingProfile,
+) -> str:
+    specs = [_snap_to_frames(spec, profile.fps or STILL_FPS) for spec in specs]
+
+    frames_number = len(specs)
+    stale_specs = [
+        spec for spec in specs
+        if graph is None or not graph.is_fresh(f"clip:{spec.name}", _clip_inputs(script, spec, frames_number, profile))
+    ]
+
+    if stale_specs:
+        # consume the iterator so worker exceptions are raised here
+        list(_map_frames(_render_clip, script, stale_specs, frames_number, workers, work_dir, profile))
+
+    if graph is not None:
+        for spec in stale_specs:
+            graph.record(
+                f"clip:{spec.name}",
+                _clip_inputs(script, spec, frames_number, profile),
+                [os.path.join(work_dir, "clips", spec.clip_name)],
+            )
+
+    return _join_clips(script, specs, work_dir)
+
+
+class StreamingClipRenderer:
+    """Renders clips while the narration is still being synthesized.
+
+    A clip only depends on its frame and its narration's duration, so `add`
+    hands it to the render workers as soon as its voice clip exists and the
+    remaining TTS requests overlap with rendering and encoding. `finish`
+    waits for the last clip and joins them like the "clips" mode does.
+    """
+
+    def __init__(
+        self,
+        script: Script,
+        workers: int = RENDER_WORKERS,
+        work_dir: str = "./assets",
+        graph: Optional[BuildGraph] = None,
+        profile: str = ENCODING_PROFILE,
+    ):
+        self.script = script
+        self.work_dir = work_dir
+        self.graph = graph
+        self.profile = get_encoding_profile(profile)
+        self.fps = self.profile.fps or STILL_FPS
+        self.frames_number = len(script.highlights) + 1
+        self.specs: list[Optional[FrameSpec]] = [None] * self.frames_number
+        self.pending: list[tuple[FrameSpec, concurrent.futures.Future]] = []
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=max(workers, 1),
+            initializer=_init_render_worker,
+            initargs=(generate_code_image(script.code),),
+        )
+
+    def add(self, frame_idx: int, voice_clip: VoiceClip):
+        spec = _snap_to_frames(_frame_spec(self.script, frame_idx, voice_clip.duration), self.fps)
+        self.specs[frame_idx] = spec
+
+        inputs = _clip_inputs(self.script, spec, self.frames_number, self.profile)
+        if self.graph is not None and self.graph.is_fresh(f"clip:{spec.name}", inputs):
+            return
+
+        logger.info("Rendering clip %s while narration continues", spec.name)
+        future = self.executor.submit(
+            _worker_render, _render_clip, spec, self.frames_number, self.work_dir, self.profile,
+        )
+        self.pending.append((spec, future))
+
+    def finish(self) -> str:
+        missing = [idx for idx, spec in enumerate(self.specs) if spec is None]
+        if missing:
+            raise ValueError(f"No voice clip for frames {missing}")
+
+        for spec, future in self.pending:
+            _collect(future.result())
+            if self.graph is not None:
+                self.graph.record(
+                    f"clip:{spec.name}",
+                    _clip_inputs(self.script, spec, self.frames_number, self.profile),
+                    [os.path.join(self.work_dir, "clips", spec.clip_name)],
+                )
+        self.executor.shutdown()
+
+        video_inputs = _video_inputs(self.script, _frame_specs(self.script), "clips", self.fps, self.profile)
+        video_path = os.path.join(self.work_dir, "clips", "final.mp4")
+        if self.graph is not None and self.graph.is_fresh("video", video_inputs):
+            logger.info("Video %s is up to date", video_path)
+            return video_path
+
+        video_path = _join_clips(self.script, self.specs, self.work_dir)
+        if self.graph is not None:
+            self.graph.record("video", video_inputs, [video_path])
+        return video_path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.executor.shutdown(cancel_futures=True)
+
+
+def _render_animated(
+    script: Script,
+    specs: list[FrameSpec],
+    fps: int,
+    work_dir: str,
+    profile: EncodingProfile,
+) -> str:
+    code_image = generate_code_image(script.code)
+    compositor = FrameCompositor(code_image)
+    animated = AnimatedCompositor(
+        base=np.asarray(compositor.base),
+        code_box=(compositor.code_image_x, code_image.width),
+        segments=[Segment(compositor.highlight_box(spec.code_block), spec.duration) for spec in specs],
+        fps=fps,
     )
+
+    video_path = os.path.join(work_dir, "clips", "final.mp4")
+    logger.info("Rendering %d animated frames", animated.frames_number)
+    with FrameStreamEncoder(video_path, voice_clips=_voice_clips(script), fps=fps, profile=profile) as encoder:
+        for frames in animated.frames():
+            encoder.write(frames.tobytes())
+
+    return video_path
+
+
+def _video_inputs(script: Script, specs: list[FrameSpec], mode: str, fps: int, profile: EncodingProfile):
+    # clips only know their narration's duration, the final video also
+    # depends on the audio itself
+    return [
+        mode,
+        fps,
+        asdict(profile),
+        script.code,
+        [asdict(spec) for spec in specs],
+        [voice_clip_key(script.intro_text)] + [voice_clip_key(code_block.text) for code_block in script.highlights],
+    ]
+
+
+def generate_video(
+    script: Script,
+    mode: str = RENDER_MODE,
+    workers: int = RENDER_WORKERS,
+    work_dir: str = "./assets",
+    fps: int = ANIMATION_FPS,
+    graph: Optional[BuildGraph] = None,
+    profile: str = ENCODING_PROFILE,
+):
+    """Render the script's video; `fps` is the frame rate of the animated mode
+    unless the encoding profile sets one for every mode."""
+    # the voice clips already exist, so there is nothing to overlap with
+    if mode == "streaming":
+        mode = "clips"
+
+    encoding = get_encoding_profile(profile)
+    fps = encoding.fps or (fps if mode == "animated" else STILL_FPS)
+
+    specs = _frame_specs(script)
+    video_inputs = _video_inputs(script, specs, mode, fps, encoding)
+    video_path = os.path.join(work_dir, "clips", "final.mp4")
+    if graph is not None and graph.is_fresh("video", video_inputs):
+        logger.info("Video %s is up to date", video_path)
+        return video_path
+
+    if mode == "single_pass":
+        video_path = _render_single_pass(script, specs, workers, work_dir, encoding)
+    elif mode == "clips":
+        video_path = _render_clips(script, specs, workers, work_dir, graph, encoding)
+    elif mode == "animated":
+        video_path = _render_animated(script, specs, fps, work_dir, encoding)
+    else:
+        raise ValueError(f"Unknown render mode: {mode}")
+
+    if graph is not None:
+        graph.record("video", video_inputs, [video_path])
+
     print(video_path)
     return video_path
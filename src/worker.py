@@ -0,0 +1,243 @@
+"""Long-lived worker generating shorts as jobs arrive.
+
+Every process pays for importing the SDKs, creating the API clients and
+building the glyph atlas; a worker pays once and then keeps them warm for
+every job it runs. Jobs are the rows of a batch manifest, read either as
+JSON lines from stdin, with one result line per finished job on stdout:
+
+    python -m src.worker < jobs.jsonl
+
+or as one JSON file per job dropped into a queue directory, which several
+workers can share; results are written to its done/ subdirectory:
+
+    python -m src.worker --queue-dir ./assets/queue
+"""
+import argparse
+import contextlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from typing import Container, Iterator, Optional, TextIO
+
+from src import audio_processing, code_image, script_processing
+from src.batch import DEFAULT_CONCURRENCY, STAGES, BatchJob, _slugify, job_from_row, run_batch
+from src.llms import grok_llama3, openai_gpt4, router
+
+
+logger = logging.getLogger(__name__)
+
+
+def warm_up(upload: bool = False):
+    """Build everything jobs share up front instead of during the first job."""
+    code_image.get_atlas()
+    code_image.get_lexer()
+    script_processing._black_mode()
+    router.get_router()
+
+    for name, get_client in [
+        ("ElevenLabs", audio_processing._get_client),
+        ("OpenAI", openai_gpt4._get_client),
+        ("Groq", grok_llama3._get_client),
+    ]:
+        try:
+            get_client()
+        except Exception as e:
+            # the job that needs it will report the error
+            logger.warning("Failed to create the %s client: %s", name, e)
+
+    if upload:
+        import src.uploaders.youtube_uploader  # noqa: F401
+
+
+def _result(job: BatchJob, error: Optional[BaseException]) -> dict:
+    return {
+        "job_id": job.job_id,
+        "video_path": job.video_path,
+        "video_id": job.video_id,
+        "error": repr(error) if error is not None else None,
+    }
+
+
+def _parse_row(text: str, source: str) -> Optional[dict]:
+    try:
+        row = json.loads(text)
+        # the same checks the manifest rows get in job_from_row
+        row["topic"], row["library"], row["title"]
+        return row
+    except (ValueError, KeyError, TypeError) as e:
+        logger.error("Skipping invalid job %s: %r", source, e)
+        return None
+
+
+def read_stdin_jobs(stream: TextIO, jobs_dir: str) -> Iterator[BatchJob]:
+    """Yield a job for every JSON line until the stream is closed."""
+    for idx, line in enumerate(stream):
+        if not line.strip():
+            continue
+        row = _parse_row(line, f"on line {idx + 1}")
+        if row is not None:
+            job_id = row.get("job_id") or f"{idx:04d}-{_slugify(row['title'])}"
+            yield job_from_row(row, job_id, jobs_dir)
+
+
+class JobQueue:
+    """A directory of <job_id>.json files shared by any number of workers.
+
+    A worker claims a job by moving its file to claimed/, which only one of
+    them can do, and writes its result to done/<job_id>.json. Claims are
+    leases: the worker touches its claimed files every `lease / 3` seconds,
+    and any worker moves claimed files untouched for `lease` seconds, e.g.
+    of a worker that crashed, back into the queue.
+    """
+
+    def __init__(self, queue_dir: str, jobs_dir: str, poll_interval: float = 1.0, lease: float = 300):
+        self.queue_dir = queue_dir
+        self.jobs_dir = jobs_dir
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.claimed_dir = os.path.join(queue_dir, "claimed")
+        self.done_dir = os.path.join(queue_dir, "done")
+        os.makedirs(self.claimed_dir, exist_ok=True)
+        os.makedirs(self.done_dir, exist_ok=True)
+        # file names of the jobs this worker claimed and hasn't finished
+        self.claimed: set[str] = set()
+        self._lock = threading.Lock()
+        threading.Thread(target=self._keep_leases, daemon=True, name="queue-leases").start()
+
+    def _claim(self, file_name: str) -> Optional[str]:
+        claimed_path = os.path.join(self.claimed_dir, file_name)
+        try:
+            os.replace(os.path.join(self.queue_dir, file_name), claimed_path)
+        except FileNotFoundError:
+            # another worker was faster
+            return None
+        # the lease starts now, not when the job was queued
+        os.utime(claimed_path)
+        with self._lock:
+            self.claimed.add(file_name)
+        with open(claimed_path) as f:
+            return f.read()
+
+    def _keep_leases(self):
+        while True:
+            with self._lock:
+                claimed = set(self.claimed)
+            for file_name in claimed:
+                with contextlib.suppress(FileNotFoundError):
+                    os.utime(os.path.join(self.claimed_dir, file_name))
+            self.requeue_expired(claimed)
+            time.sleep(self.lease / 3)
+
+    def requeue_expired(self, own: Container[str] = frozenset()):
+        """Move claimed jobs whose lease ran out, except `own`, back into the queue."""
+        expired_before = time.time() - self.lease
+        for entry in os.scandir(self.claimed_dir):
+            if entry.name in own or not entry.name.endswith(".json"):
+                continue
+            with contextlib.suppress(FileNotFoundError):
+                if entry.stat().st_mtime < expired_before:
+                    logger.warning("Lease of job %s expired, queueing it again", entry.name)
+                    os.replace(entry.path, os.path.join(self.queue_dir, entry.name))
+
+    def _queued(self) -> list[str]:
+        """File names of the queued jobs, oldest first."""
+        queued = []
+        for entry in os.scandir(self.queue_dir):
+            if not entry.name.endswith(".json"):
+                continue
+            # another worker may claim it while the queue is listed
+            with contextlib.suppress(FileNotFoundError):
+                if entry.is_file():
+                    queued.append((entry.stat().st_mtime, entry.name))
+        return [file_name for _, file_name in sorted(queued)]
+
+    def jobs(self) -> Iterator[BatchJob]:
+        """Yield queued jobs, oldest first, waiting for new ones forever."""
+        while True:
+            queued = self._queued()
+            for file_name in queued:
+                text = self._claim(file_name)
+                if text is None:
+                    continue
+                job_id = file_name[:-len(".json")]
+                row = _parse_row(text, job_id)
+                if row is None:
+                    self._write_result(job_id, {"job_id": job_id, "error": "invalid job"})
+                    continue
+                yield job_from_row(row, job_id, self.jobs_dir)
+            if not queued:
+                time.sleep(self.poll_interval)
+
+    def _write_result(self, job_id: str, result: dict):
+        result_path = os.path.join(self.done_dir, f"{job_id}.json")
+        tmp_path = result_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(result, f, indent=2)
+        os.replace(tmp_path, result_path)
+        with self._lock:
+            self.claimed.discard(f"{job_id}.json")
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(os.path.join(self.claimed_dir, f"{job_id}.json"))
+
+    def on_job_done(self, job: BatchJob, error: Optional[BaseException]):
+        self._write_result(job.job_id, _result(job, error))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate shorts for jobs read from stdin or a queue directory.")
+    parser.add_argument("--queue-dir", help="poll this directory for <job_id>.json files instead of reading stdin")
+    parser.add_argument("--jobs-dir", default="./assets/jobs", help="directory for per-job working directories")
+    parser.add_argument("--poll-interval", type=float, default=1.0, help="seconds between scans of an empty queue")
+    parser.add_argument(
+        "--lease",
+        type=float,
+        default=300,
+        help="seconds after which jobs claimed by a worker that stopped renewing them are queued again",
+    )
+    parser.add_argument("--upload", action="store_true", help="upload finished videos to YouTube")
+    for stage in STAGES:
+        parser.add_argument(
+            f"--{stage}-concurrency",
+            type=int,
+            default=DEFAULT_CONCURRENCY[stage],
+            help=f"number of jobs in the {stage} stage at the same time",
+        )
+    args = parser.parse_args()
+
+    warm_up(args.upload)
+
+    if args.queue_dir:
+        queue = JobQueue(args.queue_dir, args.jobs_dir, args.poll_interval, args.lease)
+        jobs, on_job_done = queue.jobs(), queue.on_job_done
+    else:
+        results = sys.stdout
+        results_lock = threading.Lock()
+
+        def on_job_done(job: BatchJob, error: Optional[BaseException]):
+            with results_lock:
+                results.write(json.dumps(_result(job, error)) + "\n")
+                results.flush()
+
+        jobs = read_stdin_jobs(sys.stdin, args.jobs_dir)
+
+    logger.info("Worker ready")
+    # stdout only carries results, anything the pipeline prints goes to stderr
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            run_batch(
+                jobs,
+                concurrency={stage: getattr(args, f"{stage}_concurrency") for stage in STAGES},
+                upload=args.upload,
+                on_job_done=on_job_done,
+                # a worker runs for as long as jobs arrive
+                keep_results=False,
+            )
+    except KeyboardInterrupt:
+        logger.info("Worker stopped")
+
+
+if __name__ == "__main__":
+    main()
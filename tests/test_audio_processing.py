@@ -0,0 +1,138 @@
+import http.server
+import threading
+import time
+
+import pytest
+from elevenlabs.core import ApiError
+
+from src import audio_processing, tts_cache
+
+# 40 silent MPEG-1 layer III frames, about a second of audio
+MP3 = (b"\xff\xfb\x90\x00" + bytes(413)) * 40
+
+
+class FakeTTS(http.server.BaseHTTPRequestHandler):
+    """Answers requests with MP3 after `latency` seconds.
+
+    The first requests get the `responses` instead, (status, headers) pairs
+    or "drop" to close the connection without an answer.
+    """
+
+    latency = 0.0
+    texts = []
+    responses = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        type(self).texts.append(body)
+        time.sleep(self.latency)
+        status, headers = self.responses.pop(0) if self.responses else (200, {})
+        if status == "drop":
+            self.close_connection = True
+            return
+        body = MP3 if status == 200 else b'{"detail": "error"}'
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "audio/mpeg" if status == 200 else "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def tts(tmp_path, monkeypatch):
+    FakeTTS.texts = []
+    FakeTTS.responses = []
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FakeTTS)
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    monkeypatch.setenv("ELEVEN_API_KEY", "test")
+    monkeypatch.setattr(audio_processing, "ELEVEN_BASE_URL", f"http://127.0.0.1:{server.server_port}")
+    monkeypatch.setattr(tts_cache, "TTS_CACHE_DIR", str(tmp_path / "tts"))
+    audio_processing._get_client.cache_clear()
+    yield FakeTTS
+    audio_processing._get_client.cache_clear()
+    server.shutdown()
+    server.server_close()
+
+
+def test_batch_waits_for_prefetched_clips(tts, tmp_path, monkeypatch):
+    monkeypatch.setattr(tts, "latency", 0.3)
+    prefetcher = audio_processing.AudioPrefetcher()
+    prefetcher.add("First line.")
+    prefetcher.add("Second line.")
+    prefetcher.add("First line.")
+
+    voice_clips = audio_processing.generate_audio_batch(
+        [("First line.", str(tmp_path / "a.mp3")), ("Second line.", str(tmp_path / "b.mp3"))],
+        prefetcher=prefetcher,
+    )
+
+    assert [clip.text for clip in voice_clips] == ["First line.", "Second line."]
+    assert voice_clips[0].duration == pytest.approx(1.04, abs=0.01)
+    # taken from the cache, not requested again
+    assert len(tts.texts) == 2
+
+    # a text nobody waits for doesn't hold up closing
+    prefetcher.add("Dropped line.")
+    start = time.perf_counter()
+    prefetcher.close()
+    assert time.perf_counter() - start < 0.2
+
+
+@pytest.fixture
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(audio_processing.random, "random", lambda: 0.0)
+
+
+def test_transient_errors_are_retried(tts, tmp_path, no_backoff):
+    tts.responses = [(429, {}), "drop", (503, {})]
+
+    voice_clip = audio_processing.generate_audio("Hello.", str(tmp_path / "a.mp3"))
+
+    assert voice_clip.duration == pytest.approx(1.04, abs=0.01)
+    assert len(tts.texts) == 4
+
+
+def test_retry_after_is_honoured(tts, tmp_path):
+    tts.responses = [(429, {"Retry-After": "1"})]
+
+    start = time.perf_counter()
+    audio_processing.generate_audio("Hello.", str(tmp_path / "a.mp3"))
+
+    assert time.perf_counter() - start >= 1
+    assert len(tts.texts) == 2
+
+
+def test_client_errors_are_not_retried(tts, tmp_path):
+    tts.responses = [(401, {})]
+
+    with pytest.raises(ApiError) as raised:
+        audio_processing.generate_audio("Hello.", str(tmp_path / "a.mp3"))
+
+    assert raised.value.status_code == 401
+    assert len(tts.texts) == 1
+
+
+def test_batch_retries_and_closes_its_connections(tts, tmp_path, monkeypatch, no_backoff):
+    tts.responses = [(503, {}), "drop"]
+    clients = []
+    get_async_client = audio_processing._get_async_client
+
+    def recording_client(httpx_client):
+        clients.append(httpx_client)
+        return get_async_client(httpx_client)
+
+    monkeypatch.setattr(audio_processing, "_get_async_client", recording_client)
+
+    voice_clips = audio_processing.generate_audio_batch(
+        [("First line.", str(tmp_path / "a.mp3")), ("Second line.", str(tmp_path / "b.mp3"))],
+    )
+
+    assert len(voice_clips) == 2
+    assert len(tts.texts) == 4
+    assert clients[0].is_closed
@@ -0,0 +1,32 @@
+from src.build_graph import BuildGraph
+
+
+def test_is_fresh(tmp_path):
+    output = tmp_path / "clip.mp4"
+    output.write_bytes(b"clip")
+    graph = BuildGraph(str(tmp_path))
+
+    assert not graph.is_fresh("clip", ["inputs"])
+
+    graph.record("clip", ["inputs"], [str(output)])
+    assert graph.is_fresh("clip", ["inputs"])
+    assert not graph.is_fresh("clip", ["other inputs"])
+
+    # the state survives the process
+    assert BuildGraph(str(tmp_path)).is_fresh("clip", ["inputs"])
+
+    output.unlink()
+    assert not graph.is_fresh("clip", ["inputs"])
+
+
+def test_build_only_runs_stale_nodes(tmp_path):
+    graph = BuildGraph(str(tmp_path))
+    runs = []
+
+    def build():
+        runs.append(1)
+        return "video-id"
+
+    assert graph.build("upload", ["video"], [], build) == "video-id"
+    assert graph.build("upload", ["video"], [], build) == "video-id"
+    assert len(runs) == 1
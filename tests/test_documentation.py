@@ -0,0 +1,102 @@
+import http.server
+import json
+import threading
+
+import pytest
+
+from src import documentation
+from src.documentation import CHARS_PER_TOKEN, truncate_to_budget
+
+
+def test_short_text_is_kept():
+    assert truncate_to_budget("One paragraph.", token_budget=100) == "One paragraph."
+
+
+def test_truncates_at_paragraph_boundary():
+    text = "a" * 20 + "\n\n" + "b" * 20 + "\n\n" + "c" * 20
+    truncated = truncate_to_budget(text, token_budget=50 // CHARS_PER_TOKEN)
+
+    assert truncated == "a" * 20 + "\n\n" + "b" * 20
+
+
+def test_cuts_huge_first_paragraph():
+    assert truncate_to_budget("a" * 100, token_budget=5) == "a" * 5 * CHARS_PER_TOKEN
+
+
+class FakePyPI(http.server.BaseHTTPRequestHandler):
+    """Answers every library's json with `description`, 304 when the client has `etag`."""
+
+    description = "The documentation."
+    etag = '"v1"'
+    status = 200
+    requests = []
+
+    def do_GET(self):
+        type(self).requests.append(dict(self.headers))
+        if self.status != 200:
+            self.send_response(self.status)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        elif self.headers.get("If-None-Match") == self.etag:
+            self.send_response(304)
+            self.send_header("ETag", self.etag)
+            self.end_headers()
+        else:
+            body = json.dumps({"info": {"description": self.description}}).encode()
+            self.send_response(200)
+            self.send_header("ETag", self.etag)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def pypi(tmp_path, monkeypatch):
+    FakePyPI.requests = []
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FakePyPI)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(documentation, "PYPI_URL", f"http://127.0.0.1:{server.server_port}")
+    monkeypatch.setattr(documentation, "DOCS_CACHE_DIR", str(tmp_path))
+    # every call past the first revalidates
+    monkeypatch.setattr(documentation, "DOCS_CACHE_MAX_AGE", 0)
+    yield FakePyPI
+    server.shutdown()
+    server.server_close()
+
+
+def test_not_modified_uses_cached_copy(pypi, monkeypatch):
+    assert documentation.fetch_documentation("numpy") == "The documentation."
+
+    # a changed description that is never sent, the server only answers 304
+    monkeypatch.setattr(pypi, "description", "Changed.")
+    assert documentation.fetch_documentation("numpy") == "The documentation."
+
+    assert "If-None-Match" not in pypi.requests[0]
+    assert pypi.requests[1]["If-None-Match"] == '"v1"'
+
+
+def test_changed_documentation_replaces_cached_copy(pypi, monkeypatch):
+    documentation.fetch_documentation("numpy")
+
+    monkeypatch.setattr(pypi, "description", "Changed.")
+    monkeypatch.setattr(pypi, "etag", '"v2"')
+    assert documentation.fetch_documentation("numpy") == "Changed."
+
+
+def test_failed_revalidation_uses_stale_copy(pypi, monkeypatch):
+    documentation.fetch_documentation("numpy")
+
+    monkeypatch.setattr(pypi, "status", 500)
+    assert documentation.fetch_documentation("numpy") == "The documentation."
+
+
+def test_failure_without_cached_copy_raises(pypi, monkeypatch):
+    import requests
+
+    monkeypatch.setattr(pypi, "status", 500)
+    with pytest.raises(requests.HTTPError):
+        documentation.fetch_documentation("numpy")
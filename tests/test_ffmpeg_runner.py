@@ -0,0 +1,103 @@
+import asyncio
+import shutil
+import subprocess
+import threading
+
+import pytest
+
+from src import ffmpeg_runner
+
+needs_ffmpeg = pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="needs ffmpeg")
+
+# a second of tiny test video
+TEST_SOURCE = ["-f", "lavfi", "-i", "testsrc=size=32x32:rate=10:duration=1"]
+
+
+@pytest.fixture
+def one_slot(tmp_path, monkeypatch):
+    monkeypatch.setattr(ffmpeg_runner, "FFMPEG_CONCURRENCY", 1)
+    monkeypatch.setattr(ffmpeg_runner, "FFMPEG_LOCK_DIR", str(tmp_path / "locks"))
+    monkeypatch.setattr(ffmpeg_runner, "_local_slots", threading.BoundedSemaphore(1))
+
+
+def test_progress_reports_are_parsed():
+    progress = ffmpeg_runner.Progress()
+    for line in ["frame=12", "fps=N/A", "out_time_us=1500000", "speed=2.5x", "progress=end"]:
+        progress.update(*line.split("="))
+
+    assert progress == ffmpeg_runner.Progress(frame=12, out_time=1.5, speed=2.5, done=True)
+
+
+@pytest.mark.parametrize("posix", [True, False])
+def test_slot_wait_can_be_cancelled(one_slot, monkeypatch, posix):
+    if not posix:
+        # the fallback without lock files, as on Windows
+        monkeypatch.setattr(ffmpeg_runner, "fcntl", None)
+    cancel = threading.Event()
+
+    with ffmpeg_runner.slot():
+        threading.Timer(0.1, cancel.set).start()
+        with pytest.raises(ffmpeg_runner.FFmpegCancelled):
+            with ffmpeg_runner.slot(cancel):
+                pass
+
+    # given back, the next one gets it right away
+    with ffmpeg_runner.slot():
+        pass
+
+
+@needs_ffmpeg
+def test_run_returns_output_and_progress(one_slot):
+    reports = []
+
+    output = ffmpeg_runner.run(
+        TEST_SOURCE + ["-f", "rawvideo", "-pix_fmt", "gray", "-"],
+        "test",
+        capture_output=True,
+        on_progress=lambda progress: reports.append(progress.frame),
+    )
+
+    assert len(output) == 10 * 32 * 32
+    assert reports[-1] == 10
+
+
+@needs_ffmpeg
+def test_failure_raises_with_stderr(one_slot):
+    with pytest.raises(ffmpeg_runner.FFmpegError) as raised:
+        ffmpeg_runner.run(["-i", "missing.mp4", "-f", "null", "-"], "test")
+
+    assert "missing.mp4" in raised.value.stderr
+
+
+@needs_ffmpeg
+def test_timeout_kills_ffmpeg(one_slot):
+    with pytest.raises(subprocess.TimeoutExpired):
+        ffmpeg_runner.run(["-re", "-f", "lavfi", "-i", "testsrc", "-f", "null", "-"], "test", timeout=0.3)
+
+    # the killed process gave its slot back
+    with ffmpeg_runner.slot():
+        pass
+
+
+@needs_ffmpeg
+def test_cancelled_while_queued_never_starts(one_slot, monkeypatch):
+    started = []
+    start = ffmpeg_runner.FFmpegProcess._start
+
+    def recording_start(self, *args):
+        started.append(self.name)
+        start(self, *args)
+
+    monkeypatch.setattr(ffmpeg_runner.FFmpegProcess, "_start", recording_start)
+
+    async def cancel_queued():
+        task = asyncio.ensure_future(ffmpeg_runner.run_async(TEST_SOURCE + ["-f", "null", "-"], "queued"))
+        await asyncio.sleep(0.2)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    with ffmpeg_runner.slot():
+        asyncio.run(cancel_queued())
+
+    assert started == []
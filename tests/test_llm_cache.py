@@ -0,0 +1,79 @@
+import sqlite3
+
+import pytest
+
+from src.llms import cache
+
+
+@pytest.fixture
+def llm_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "LLM_CACHE_PATH", str(tmp_path / "llm.sqlite"))
+    monkeypatch.setattr(cache, "LLM_CACHE_TTL", 3600)
+    monkeypatch.setattr(cache, "LLM_CACHE_MAX_ENTRIES", 2)
+
+
+def cached_keys() -> set[str]:
+    connection = sqlite3.connect(cache.LLM_CACHE_PATH)
+    try:
+        return {key for key, in connection.execute("SELECT key FROM responses")}
+    finally:
+        connection.close()
+
+
+def test_llm_cache_evicts_least_recently_used(llm_cache):
+    cache._put("old", "a")
+    cache._put("used", "b")
+    assert cache._get("used") == "b"
+    cache._put("new", "c")
+
+    assert cached_keys() == {"used", "new"}
+
+
+def test_llm_cache_expires_entries(llm_cache, monkeypatch):
+    cache._put("key", "a")
+    monkeypatch.setattr(cache, "LLM_CACHE_TTL", 0.000001)
+
+    assert cache._get("key") is None
+
+
+def test_llm_cache_forget_and_skip(llm_cache):
+    calls = []
+
+    @cache.cached("fake", "model")
+    def invoke(prompt, temperature=0.3, max_tokens=1024):
+        calls.append(prompt)
+        return f"answer {len(calls)}"
+
+    assert invoke("prompt") == "answer 1"
+    assert invoke("prompt") == "answer 1"
+    # asked again but not stored
+    assert invoke("prompt", use_cache=False) == "answer 2"
+    assert invoke("prompt") == "answer 1"
+
+    invoke.forget("prompt")
+    assert invoke("prompt") == "answer 3"
+    assert len(calls) == 3
+
+
+def test_llm_cache_shares_identical_requests(llm_cache, monkeypatch):
+    calls = []
+    in_flight_at_store = []
+    store = cache._store
+
+    def checked_store(key, response):
+        in_flight_at_store.append(key in cache._in_flight)
+        store(key, response)
+
+    @cache.cached("fake", "model")
+    def invoke(prompt, temperature=0.3, max_tokens=1024):
+        calls.append(prompt)
+        return "answer"
+
+    monkeypatch.setattr(cache, "_store", checked_store)
+    assert invoke("prompt") == "answer"
+
+    # no moment where neither the cache nor the in-flight request has it
+    assert in_flight_at_store == [True]
+    assert invoke("prompt") == "answer"
+    assert len(calls) == 1
+    assert in_flight_at_store == [True]
@@ -0,0 +1,169 @@
+import threading
+import time
+
+import pytest
+
+from src.llms.router import Backend, LLMError, Route, Router, routes_from_env
+
+
+class FakeBackend:
+    """Answers with its name after `delay` seconds, or raises `error`."""
+
+    def __init__(self, name: str, delay: float = 0.0, error: Exception = None, chunks: int = 3):
+        self.name = name
+        self.delay = delay
+        self.error = error
+        self.chunks = chunks
+        self.calls = 0
+        self.closed = 0
+        # set at the end of a test so slow requests that lost a race return
+        self.release = threading.Event()
+
+    def _wait(self):
+        self.calls += 1
+        self.release.wait(self.delay)
+        if self.error is not None:
+            raise self.error
+
+    def invoke(self, prompt, temperature=0.3, max_tokens=1024, use_cache=True):
+        self._wait()
+        return self.name
+
+    def invoke_stream(self, prompt, temperature=0.3, max_tokens=1024, use_cache=True):
+        try:
+            self._wait()
+            for _ in range(self.chunks):
+                yield self.name
+        finally:
+            self.closed += 1
+
+    def backend(self, cost: float = 0.0) -> Backend:
+        return Backend(self.name, self.invoke, self.invoke_stream, cost=cost)
+
+
+def make_router(*fakes, hedge_after=0.1, **route):
+    backends = {fake.name: fake.backend() for fake in fakes}
+    routes = {"step": Route([fake.name for fake in fakes], **{"latency_target": 10, **route})}
+    return Router(backends, routes, hedge_after=hedge_after)
+
+
+@pytest.fixture
+def fakes():
+    created = []
+
+    def create(*args, **kwargs):
+        fake = FakeBackend(*args, **kwargs)
+        created.append(fake)
+        return fake
+
+    yield create
+    for fake in created:
+        fake.release.set()
+
+
+def test_first_backend_answers(fakes):
+    first, second = fakes("first"), fakes("second")
+    router = make_router(first, second)
+
+    assert router.invoke("step", "prompt") == "first"
+    assert second.calls == 0
+
+
+def test_slow_backend_is_hedged(fakes):
+    slow, fast = fakes("slow", delay=5), fakes("fast")
+    router = make_router(slow, fast, hedge_after=0.1)
+
+    start = time.perf_counter()
+    assert router.invoke("step", "prompt") == "fast"
+    assert time.perf_counter() - start < 1
+
+
+def test_failed_backend_fails_over_and_is_demoted(fakes):
+    broken, working = fakes("broken", error=RuntimeError("down")), fakes("working")
+    router = make_router(broken, working, hedge_after=0)
+
+    assert router.invoke("step", "prompt") == "working"
+    assert [backend.name for backend in router.candidates("step")] == ["working", "broken"]
+
+
+def test_every_backend_failing_raises(fakes):
+    error = RuntimeError("down")
+    router = make_router(fakes("a", error=error), fakes("b", error=error))
+
+    with pytest.raises(LLMError) as raised:
+        router.invoke("step", "prompt")
+    assert raised.value.__cause__ is error
+
+
+def test_slow_backend_moves_behind_latency_target(fakes):
+    slow, fast = fakes("slow", delay=0.2), fakes("fast")
+    router = make_router(slow, fast, hedge_after=0, latency_target=0.1)
+
+    router.invoke("step", "prompt")
+
+    assert router.latency[("step", "slow")] > 0.1
+    assert [backend.name for backend in router.candidates("step")] == ["fast", "slow"]
+
+
+def test_backend_over_cost_limit_is_tried_last(fakes):
+    pricey, cheap = fakes("pricey"), fakes("cheap")
+    router = Router(
+        {"pricey": pricey.backend(cost=10), "cheap": cheap.backend(cost=0.1)},
+        {"step": Route(["pricey", "cheap"], latency_target=10, max_cost=1)},
+    )
+
+    assert router.invoke("step", "prompt") == "cheap"
+
+
+def test_stream_is_hedged_on_first_chunk_and_loser_closed(fakes):
+    slow, fast = fakes("slow", delay=5), fakes("fast")
+    router = make_router(slow, fast, hedge_after=0.1)
+
+    assert list(router.invoke_stream("step", "prompt")) == ["fast"] * 3
+
+    slow.release.set()
+    deadline = time.monotonic() + 2
+    while slow.closed == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert slow.closed == 1
+    assert fast.closed == 1
+
+
+def test_stream_latency_covers_whole_answer(fakes):
+    backend = fakes("backend", chunks=3)
+    router = make_router(backend)
+
+    def slow_chunks(prompt, temperature=0.3, max_tokens=1024, use_cache=True):
+        for _ in range(3):
+            time.sleep(0.05)
+            yield "chunk"
+
+    router.backends["backend"].invoke_stream = slow_chunks
+    list(router.invoke_stream("step", "prompt"))
+
+    assert router.latency[("step", "backend")] >= 0.15
+
+
+def test_routes_from_env():
+    routes = routes_from_env("code=b,a@latency=3,max_cost=1;custom=c")
+
+    assert routes["code"] == Route(["b", "a"], latency_target=3, max_cost=1)
+    assert routes["custom"].backends == ["c"]
+    # steps that aren't mentioned keep their defaults
+    assert routes["description"].backends == ["openai", "groq"]
+
+    with pytest.raises(ValueError):
+        routes_from_env("code=a@speed=3")
+
+
+def test_hung_backend_does_not_stall_later_requests(fakes):
+    hung, working = fakes("hung", delay=60), fakes("working")
+    router = make_router(hung, working, hedge_after=0.1)
+
+    start = time.perf_counter()
+    for _ in range(30):
+        assert router.invoke("step", "prompt") == "working"
+
+    # only the first request waited for the hedge
+    assert time.perf_counter() - start < 1
+    assert hung.calls == 1
@@ -0,0 +1,51 @@
+import threading
+
+import pytest
+
+from src import script_processing
+from src.llms import router
+
+
+class FakeRouter:
+    """Answers each step, checking what was narrated before the answer was complete."""
+
+    def __init__(self):
+        self.narrated: list[tuple[int, str]] = []
+        self.intro_narrated = threading.Event()
+        self.narrated_before_second_row = None
+
+    def invoke(self, step, prompt, temperature=0.3, max_tokens=1024, use_cache=True):
+        if step == "description":
+            return "The intro."
+        # the code is only written once the intro is being narrated
+        assert self.intro_narrated.wait(5)
+        return "import numpy as np\nprint(np.zeros(3))\n"
+
+    def invoke_stream(self, step, prompt, temperature=0.3, max_tokens=1024, use_cache=True):
+        yield "1|1|Imports numpy\n"
+        self.narrated_before_second_row = list(self.narrated)
+        yield "2|2|Prints zeros\n"
+
+    def forget(self, step, prompt, temperature=0.3, max_tokens=1024):
+        pass
+
+    def on_narration(self, idx: int, text: str):
+        self.narrated.append((idx, text))
+        if idx == 0:
+            self.intro_narrated.set()
+
+
+@pytest.fixture
+def fake_router(monkeypatch):
+    fake = FakeRouter()
+    monkeypatch.setattr(router, "_router", fake)
+    monkeypatch.setattr(script_processing, "_fetch_documentation", lambda library: "")
+    return fake
+
+
+def test_narration_is_passed_on_as_it_is_written(fake_router):
+    script = script_processing.generate_script("numpy", "numpy", on_narration=fake_router.on_narration)
+
+    assert [highlight.text for highlight in script.highlights] == ["Imports numpy", "Prints zeros"]
+    assert fake_router.narrated_before_second_row == [(0, "The intro."), (1, "Imports numpy")]
+    assert fake_router.narrated == [(0, "The intro."), (1, "Imports numpy"), (2, "Prints zeros")]
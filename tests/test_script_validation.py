@@ -0,0 +1,65 @@
+import pytest
+
+from src.script_processing import (
+    MAX_CODE_LINES,
+    MAX_LINE_LENGTH,
+    ScriptCodeHighlight,
+    ScriptValidationError,
+    parse_highlights,
+    validate_code,
+    validate_highlight,
+)
+
+
+def test_parse_highlights_across_chunks():
+    answer = "```csv\nstart_line_number|end_line_number|description_of_the_block\n1|2|Imports the library\n3|3|Calls it```"
+    # split mid-row, like a streamed answer
+    chunks = [answer[start:start + 7] for start in range(0, len(answer), 7)]
+
+    assert list(parse_highlights(chunks)) == [
+        ScriptCodeHighlight(text="Imports the library", line_number=0, line_count=2),
+        ScriptCodeHighlight(text="Calls it", line_number=2, line_count=1),
+    ]
+
+
+def test_parse_highlights_collects_malformed_rows():
+    errors = []
+    highlights = list(parse_highlights(["1|1|fine\n", "not a row\n", "a|b|words\n"], errors))
+
+    assert [highlight.text for highlight in highlights] == ["fine"]
+    assert len(errors) == 2
+
+
+def test_validate_code_accepts_code_that_fits():
+    validate_code("import numpy as np\n\nprint(np.zeros(3))\n")
+
+
+@pytest.mark.parametrize(
+    "code",
+    [
+        "",
+        "x = 1\n" * (MAX_CODE_LINES + 1),
+        "x = '" + "a" * MAX_LINE_LENGTH + "'\n",
+    ],
+)
+def test_validate_code_rejects(code):
+    with pytest.raises(ScriptValidationError):
+        validate_code(code)
+
+
+def test_validate_highlight_accepts_lines_of_the_code():
+    validate_highlight(ScriptCodeHighlight(text="All of it", line_number=0, line_count=3), code_lines=3)
+
+
+@pytest.mark.parametrize(
+    "highlight",
+    [
+        ScriptCodeHighlight(text="Past the end", line_number=2, line_count=2),
+        ScriptCodeHighlight(text="Before the start", line_number=-1, line_count=1),
+        ScriptCodeHighlight(text="Backwards", line_number=1, line_count=0),
+        ScriptCodeHighlight(text="  ", line_number=0, line_count=1),
+    ],
+)
+def test_validate_highlight_rejects(highlight):
+    with pytest.raises(ScriptValidationError):
+        validate_highlight(highlight, code_lines=3)
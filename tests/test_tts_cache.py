@@ -0,0 +1,41 @@
+import os
+
+import pytest
+
+from src import tts_cache
+
+
+@pytest.fixture
+def tts_cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(tts_cache, "TTS_CACHE_DIR", str(tmp_path / "tts"))
+    return tmp_path
+
+
+def put_clip(tmp_path, key: str, size: int, accessed_at: float):
+    clip = tmp_path / f"{key}-clip.mp3"
+    clip.write_bytes(b"x" * size)
+    tts_cache.put(key, str(clip), duration=1.5)
+    audio_path, _ = tts_cache._entry_paths(key)
+    os.utime(audio_path, (accessed_at, accessed_at))
+
+
+def test_tts_cache_roundtrip(tts_cache_dir):
+    put_clip(tts_cache_dir, "key", 10, accessed_at=1)
+    save_as = tts_cache_dir / "out.mp3"
+
+    assert tts_cache.get("key", str(save_as)) == 1.5
+    assert save_as.read_bytes() == b"x" * 10
+    assert tts_cache.get("missing", str(save_as)) is None
+
+
+def test_tts_cache_evicts_least_recently_used(tts_cache_dir):
+    put_clip(tts_cache_dir, "old", 10, accessed_at=1)
+    put_clip(tts_cache_dir, "used", 10, accessed_at=2)
+    put_clip(tts_cache_dir, "new", 10, accessed_at=3)
+    # a hit makes "used" the most recently used entry
+    tts_cache.get("used", str(tts_cache_dir / "out.mp3"))
+
+    tts_cache.evict(max_bytes=20)
+
+    remaining = sorted(name for name in os.listdir(tts_cache.TTS_CACHE_DIR))
+    assert remaining == ["new.json", "new.mp3", "used.json", "used.mp3"]
@@ -0,0 +1,27 @@
+import shutil
+
+import pytest
+
+from src import ffmpeg_runner
+from src.video_processing import ENCODING_PROFILES, FrameStreamEncoder
+
+pytestmark = pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="needs ffmpeg")
+
+
+def count_frames(path: str) -> int:
+    # one line per decoded frame after the header comments
+    output = ffmpeg_runner.run(["-i", path, "-map", "0:v", "-f", "framecrc", "-"], "count frames", capture_output=True)
+    return sum(1 for line in output.decode().splitlines() if not line.startswith("#"))
+
+
+@pytest.mark.parametrize("stills", [3, 200])
+def test_stills_are_shown_for_their_durations(tmp_path, stills):
+    output_path = str(tmp_path / "video.mp4")
+    profile = ENCODING_PROFILES["draft"]
+    durations = [0.1] * stills
+
+    with FrameStreamEncoder(output_path, durations, frame_w=16, frame_h=16, fps=profile.fps, profile=profile) as encoder:
+        for idx in range(stills):
+            encoder.write(bytes([idx % 256]) * 16 * 16 * 3)
+
+    assert count_frames(output_path) == pytest.approx(stills * 0.1 * profile.fps, abs=1)
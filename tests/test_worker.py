@@ -0,0 +1,52 @@
+import json
+import os
+
+from src import worker
+
+
+def queue_job(queue_dir, job_id: str, mtime: float):
+    path = os.path.join(queue_dir, f"{job_id}.json")
+    with open(path, "w") as f:
+        json.dump({"topic": job_id, "library": "numpy", "title": job_id}, f)
+    os.utime(path, (mtime, mtime))
+
+
+def test_jobs_are_claimed_oldest_first(tmp_path):
+    queue = worker.JobQueue(str(tmp_path / "queue"), str(tmp_path / "jobs"))
+    queue_job(queue.queue_dir, "new", mtime=2)
+    queue_job(queue.queue_dir, "old", mtime=1)
+
+    jobs = queue.jobs()
+    assert [next(jobs).job_id, next(jobs).job_id] == ["old", "new"]
+    assert sorted(os.listdir(queue.claimed_dir)) == ["new.json", "old.json"]
+
+
+def test_job_claimed_by_another_worker_while_listing_is_skipped(tmp_path, monkeypatch):
+    queue = worker.JobQueue(str(tmp_path / "queue"), str(tmp_path / "jobs"))
+    queue_job(queue.queue_dir, "taken", mtime=1)
+    queue_job(queue.queue_dir, "free", mtime=2)
+    scandir = os.scandir
+
+    def scandir_then_claim(path):
+        entries = list(scandir(path))
+        # another worker claims a job right after the listing
+        if path == queue.queue_dir and os.path.exists(os.path.join(path, "taken.json")):
+            os.replace(os.path.join(path, "taken.json"), os.path.join(queue.claimed_dir, "taken.json"))
+        return iter(entries)
+
+    monkeypatch.setattr(worker.os, "scandir", scandir_then_claim)
+
+    assert next(queue.jobs()).job_id == "free"
+
+
+def test_expired_claims_are_queued_again(tmp_path, monkeypatch):
+    # requeued by hand below, not by the queue's own thread
+    monkeypatch.setattr(worker.JobQueue, "_keep_leases", lambda self: None)
+    queue = worker.JobQueue(str(tmp_path / "queue"), str(tmp_path / "jobs"), lease=60)
+    queue_job(queue.claimed_dir, "orphan", mtime=1)
+    queue_job(queue.claimed_dir, "mine", mtime=1)
+
+    queue.requeue_expired(own={"mine.json"})
+
+    assert sorted(name for name in os.listdir(queue.queue_dir) if name.endswith(".json")) == ["orphan.json"]
+    assert os.listdir(queue.claimed_dir) == ["mine.json"]
@@ -0,0 +1,151 @@
+import http.server
+import json
+import os
+import re
+import threading
+
+import pytest
+from googleapiclient.http import HttpRequest
+
+from src.uploaders import youtube_uploader
+
+CHUNK = 256 * 1024
+
+
+class FakeUploads(http.server.BaseHTTPRequestHandler):
+    """A resumable upload endpoint: POST starts a session, PUTs send its chunks.
+
+    Chunks starting at an offset in `fail_once` get a 503 the first time.
+    """
+
+    protocol_version = "HTTP/1.1"
+    sessions = {}
+    posts = 0
+    fail_once = set()
+
+    def _send(self, status: int, headers=(), body: bytes = b""):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _done(self, session_id: str):
+        self._send(200, [("Content-Type", "application/json")], json.dumps({"id": f"video-{session_id}"}).encode())
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        type(self).posts += 1
+        session_id = str(self.posts)
+        self.sessions[session_id] = b""
+        self._send(200, [("Location", f"http://127.0.0.1:{self.server.server_port}/session/{session_id}")])
+
+    def do_PUT(self):
+        session_id = self.path.rsplit("/", 1)[1]
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if session_id not in self.sessions:
+            return self._send(404)
+        received = self.sessions[session_id]
+
+        status_query = re.match(r"bytes \*/(\d+)", self.headers["Content-Range"])
+        if status_query:
+            if len(received) == int(status_query.group(1)):
+                return self._done(session_id)
+            return self._send(308, [("Range", f"bytes=0-{len(received) - 1}")] if received else [])
+
+        first, last, total = map(int, re.match(r"bytes (\d+)-(\d+)/(\d+)", self.headers["Content-Range"]).groups())
+        if first in self.fail_once:
+            self.fail_once.discard(first)
+            return self._send(503)
+        assert first == len(received)
+        self.sessions[session_id] = received + body
+        if last + 1 == total:
+            return self._done(session_id)
+        self._send(308, [("Range", f"bytes=0-{last}")])
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def uploads(tmp_path, monkeypatch):
+    FakeUploads.sessions = {}
+    FakeUploads.posts = 0
+    FakeUploads.fail_once = set()
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FakeUploads)
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+
+    token_file = tmp_path / "token.json"
+    token_file.write_text(json.dumps({
+        "token": "token", "refresh_token": "refresh", "client_id": "id", "client_secret": "secret",
+        "expiry": "2099-01-01T00:00:00Z",
+    }))
+    monkeypatch.setattr(youtube_uploader, "YOUTUBE_API_ENDPOINT", f"http://127.0.0.1:{server.server_port}")
+    monkeypatch.setattr(youtube_uploader, "YOUTUBE_TOKEN_FILE", str(token_file))
+    monkeypatch.setattr(youtube_uploader, "YOUTUBE_UPLOAD_SESSIONS_DIR", str(tmp_path / "sessions"))
+    monkeypatch.setattr(youtube_uploader, "_credentials", None)
+    monkeypatch.setattr(youtube_uploader.random, "random", lambda: 0.0)
+    yield FakeUploads
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def video(tmp_path):
+    path = tmp_path / "video.mp4"
+    path.write_bytes(os.urandom(5 * CHUNK + 1000))
+    return youtube_uploader.UploadOptions(
+        file=str(path), title="Title", description="Description", category="27", keywords="a,b",
+        privacyStatus="private",
+    )
+
+
+def crash_after(monkeypatch, chunks: int):
+    next_chunk = HttpRequest.next_chunk
+    calls = []
+
+    def crashing(self, *args, **kwargs):
+        calls.append(1)
+        if len(calls) > chunks:
+            raise KeyboardInterrupt
+        return next_chunk(self, *args, **kwargs)
+
+    monkeypatch.setattr(HttpRequest, "next_chunk", crashing)
+
+
+def read(options) -> bytes:
+    with open(options.file, "rb") as f:
+        return f.read()
+
+
+def test_failed_chunk_is_retried(uploads, video):
+    uploads.fail_once = {2 * CHUNK}
+
+    assert youtube_uploader.upload_to_youtube(video, chunksize=CHUNK) == "video-1"
+    assert uploads.sessions["1"] == read(video)
+    assert not os.listdir(youtube_uploader.YOUTUBE_UPLOAD_SESSIONS_DIR)
+
+
+def test_interrupted_upload_resumes(uploads, video):
+    with pytest.MonkeyPatch.context() as patch:
+        crash_after(patch, chunks=2)
+        with pytest.raises(KeyboardInterrupt):
+            youtube_uploader.upload_to_youtube(video, chunksize=CHUNK)
+    assert len(uploads.sessions["1"]) == 2 * CHUNK
+
+    assert youtube_uploader.upload_to_youtube(video, chunksize=CHUNK) == "video-1"
+    assert uploads.posts == 1
+    assert uploads.sessions["1"] == read(video)
+
+
+def test_expired_session_starts_over(uploads, video):
+    with pytest.MonkeyPatch.context() as patch:
+        crash_after(patch, chunks=2)
+        with pytest.raises(KeyboardInterrupt):
+            youtube_uploader.upload_to_youtube(video, chunksize=CHUNK)
+    uploads.sessions.clear()
+
+    assert youtube_uploader.upload_to_youtube(video, chunksize=CHUNK) == "video-2"
+    assert uploads.sessions["2"] == read(video)